@@ -0,0 +1,434 @@
+"""Офлайн-бенчмарки горячих путей: разбор поиска IMDb, поиск по каталогу, обогащение, OMDB и MongoDB.
+
+Внешние API подменяются локальным HTTP-сервером с заготовленными ответами, MongoDB — коллекцией
+в памяти (или настоящим mongod через --mongo-uri). Страницы поиска IMDb по умолчанию генерируются;
+сохранённые страницы можно подложить через --fixtures (файлы *.html).
+
+    python benchmark.py --sizes 1000 10000 100000 --json bench.json
+    python benchmark.py --baseline bench.json  # ненулевой код выхода при замедлении
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import main
+import omdb
+from catalog import CatalogIndex
+from discovery import parse_search_page
+from sink import sync_to_mongodb
+from snapshot import CatalogSnapshot, SnapshotCatalog, save_catalog, write_snapshot
+
+PAGE_SIZE = 250
+
+
+def fake_ttid(i):
+    return f"tt{1000000 + i}"
+
+
+def search_page_html(start, count, next_data=True):
+    """Страница поиска IMDb в той же разметке, что отдаёт сайт (__NEXT_DATA__ или элементы списка)."""
+    indexes = range(start, start + count)
+    if next_data:
+        items = [{"titleId": fake_ttid(i), "titleText": {"text": f"Anime {i}"}, "releaseYear": {"year": 1990 + i % 35},
+                  "ratingSummary": {"aggregateRating": round(5 + i % 50 / 10, 1)}} for i in indexes]
+        payload = {"props": {"pageProps": {"searchResults": {"titleResults": {"titleListItems": items}}}}}
+        return ('<html><body><script id="__NEXT_DATA__" type="application/json">'
+                f'{json.dumps(payload)}</script></body></html>')
+    rows = "".join(
+        f'<li class="ipc-metadata-list-summary-item"><div><a href="/title/{fake_ttid(i)}/?ref_=sr">'
+        f'<h3 class="ipc-title__text">{i + 1}. Anime {i}</h3></a>'
+        f'<span class="dli-title-metadata-item">{1990 + i % 35}–</span>'
+        f'<span class="ipc-rating-star--rating">{5 + i % 50 / 10:.1f}</span></div></li>'
+        for i in indexes
+    )
+    return f'<html><body><ul class="ipc-metadata-list">{rows}</ul></body></html>'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Локальная замена IMDb, TMDB, AniList и OMDB с детерминированными ответами."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type="application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith("/search/title"):
+            start = int(query.get("start", ["1"])[0]) - 1
+            self._send(search_page_html(start, int(query.get("count", [PAGE_SIZE])[0])), "text/html")
+        elif url.path.startswith("/3/find/"):
+            number = int(url.path.rsplit("/", 1)[1][2:])
+            self._send({"tv_results": [{"id": number}], "movie_results": []})
+        elif url.path.startswith(("/3/tv/", "/3/movie/")):
+            self._send({"overview": "Описание", "poster_path": "/poster.jpg", "backdrop_path": "/backdrop.jpg",
+                        "vote_average": 7.5, "status": "Ended", "images": {"posters": []}})
+        elif url.path.startswith("/omdb"):
+            ttid = query["i"][0]
+            self._send({"Title": f"Anime {ttid}", "Year": "2001", "imdbRating": "7.0", "imdbID": ttid,
+                        "Response": "True"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        media = {"tags": [{"name": "Magic"}, {"name": "Dragons"}, {"name": "Unknown"}],
+                 "genres": ["Action", "Fantasy"], "episodes": 12}
+        variables = body.get("variables", {})
+        if "search" in variables or "id" in variables:
+            self._send({"data": {"Media": media}})
+        else:
+            self._send({"data": {f"m{name[1:]}": media for name in variables}})
+
+
+@contextlib.contextmanager
+def stand_in_server():
+    """Поднимает локальный сервер и направляет на него адреса внешних API."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    originals = (main.TMDB_BASE_URL, main.ANILIST_URL, omdb.OMDB_URL)
+    main.TMDB_BASE_URL, main.ANILIST_URL, omdb.OMDB_URL = f"{base}/3", f"{base}/graphql", f"{base}/omdb/"
+    try:
+        yield base
+    finally:
+        main.TMDB_BASE_URL, main.ANILIST_URL, omdb.OMDB_URL = originals
+        server.shutdown()
+
+
+class MemoryCollection:
+    """Коллекция MongoDB в памяти: ровно то, что использует sink (find по $in и bulk_write с upsert)."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def find(self, query, projection=None):
+        key, condition = next(iter(query.items()))
+        for value in condition["$in"]:
+            document = self.documents.get((key, value))
+            if document is not None:
+                yield dict(document)
+
+    def bulk_write(self, operations, ordered=True):
+        upserted = modified = 0
+        for operation in operations:
+            (key, value), = operation._filter.items()
+            document = self.documents.get((key, value))
+            if document is None:
+                self.documents[(key, value)] = {key: value, **operation._doc["$set"]}
+                upserted += 1
+            else:
+                document.update(operation._doc["$set"])
+                modified += 1
+        return SimpleNamespace(upserted_count=upserted, modified_count=modified)
+
+
+class MemoryClient:
+    def __init__(self):
+        self.collection = MemoryCollection()
+
+    def __getitem__(self, name):
+        return _MemoryDatabase(self.collection)
+
+    def close(self):
+        pass
+
+
+class _MemoryDatabase:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return self.collection
+
+
+def make_catalog_records(size):
+    return [{"ID": i + 1, "TitleEng": f"Anime {i}", "TitleRu": f"Аниме {i}", "TTID": fake_ttid(i),
+             "Year": str(1990 + i % 35), "IMDbRating": "7.0", "TMDbRating": 7.5, "Status": "Завершён",
+             "Tags": ["Магия"], "Genres": ["Экшен"]} for i in range(size)]
+
+
+def measure(name, size, items, operation, batch_size):
+    """Выполняет operation(batch) по пакетам и возвращает пропускную способность и p50/p95 на пакет."""
+    latencies = []
+    started = time.perf_counter()
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        batch_started = time.perf_counter()
+        operation(batch)
+        latencies.append((time.perf_counter() - batch_started) * 1000)
+    elapsed = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=20) if len(latencies) > 1 else latencies * 19
+    return {
+        "name": name,
+        "size": size,
+        "items": len(items),
+        "batch": batch_size,
+        "throughput": len(items) / elapsed if elapsed else float("inf"),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": quantiles[18],
+    }
+
+
+def bench_parse(size, fixtures):
+    results = []
+    pages = [search_page_html(start, PAGE_SIZE) for start in range(0, size, PAGE_SIZE)]
+    results.append(measure("parse_next_data", size, pages, lambda batch: [parse_search_page(p) for p in batch], 1))
+    html_pages = fixtures or [search_page_html(start, PAGE_SIZE, next_data=False)
+                              for start in range(0, min(size, 10 * PAGE_SIZE), PAGE_SIZE)]
+    results.append(measure("parse_html_items", size, html_pages,
+                           lambda batch: [parse_search_page(p) for p in batch], 1))
+    for result in results:
+        result["unit"] = "pages"
+    return results
+
+
+def bench_catalog(size):
+    records = make_catalog_records(size)
+    build = measure("catalog_build", size, [records], lambda batch: CatalogIndex(batch[0]), 1)
+    catalog = CatalogIndex(records)
+    probes = [fake_ttid(random.randrange(size * 2)) for _ in range(max(size, 10000))]
+    lookup = measure("is_anime_exists", size, probes,
+                     lambda batch: [main.is_anime_exists(ttid, catalog) for ttid in batch], 1000)
+    build["unit"] = "catalogs"
+    lookup["unit"] = "lookups"
+    return [build, lookup]
+
+
+# Загрузка каталога в отдельном процессе: печатает прирост пикового RSS (МБ) после загрузки.
+# На Linux ru_maxrss наследуется от родителя через fork, поэтому пик берётся из VmHWM нового процесса.
+RSS_SCRIPT = """
+import resource, sys
+sys.path.insert(0, {directory!r})
+import main, snapshot
+
+def peak_mb():
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+before = peak_mb()
+catalog = {loader}
+assert {probe!r} in catalog
+print(peak_mb() - before)
+"""
+
+
+def child_rss(loader, probe):
+    """Пиковый прирост памяти процесса, загрузившего каталог выражением `loader` (None, если не замерить)."""
+    script = RSS_SCRIPT.format(directory=str(Path(__file__).resolve().parent), loader=loader, probe=probe)
+    try:
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        return round(float(output.strip().splitlines()[-1]), 1)
+    except (subprocess.CalledProcessError, ValueError, IndexError):
+        return None  # Например, на Windows нет модуля resource
+
+
+def bench_catalog_files(size, workdir):
+    """Загрузка и сохранение каталога: полный JSON против снимка (snapshot.py)."""
+    records = make_catalog_records(size)
+    json_file = Path(workdir) / f"catalog_{size}.json"
+    snapshot_file = json_file.with_suffix(".bin")
+    with open(json_file, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=4)
+    write_snapshot(records, snapshot_file)
+    probe = records[-1]["TTID"]
+
+    def open_snapshot(batch):
+        catalog = CatalogSnapshot(snapshot_file)
+        assert probe in catalog
+        catalog.close()
+
+    results = [
+        measure("load_json", size, [json_file], lambda batch: main.load_catalog(batch[0]), 1),
+        measure("load_snapshot", size, [snapshot_file], open_snapshot, 1),
+    ]
+    results[0]["rss_mb"] = child_rss(f"main.load_catalog({str(json_file)!r})", probe)
+    results[1]["rss_mb"] = child_rss(f"snapshot.CatalogSnapshot({str(snapshot_file)!r})", probe)
+
+    def save_json(batch):
+        catalog = main.load_catalog(json_file)
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(catalog.records, f, ensure_ascii=False, indent=4)
+
+    def save_stream(batch):
+        catalog = SnapshotCatalog(CatalogSnapshot(snapshot_file))
+        save_catalog(catalog, json_file, snapshot_file)
+        catalog.close()
+
+    results.append(measure("save_json", size, [json_file], save_json, 1))
+    results.append(measure("save_snapshot", size, [json_file], save_stream, 1))
+    for result in results:
+        result["unit"] = "catalogs"
+    return results
+
+
+def bench_enrichment(size, limit):
+    count = min(size, limit)
+    config = main.AnimeConfig()
+    config.TMDB_API_KEY = "bench"
+    config.TMDB_RATE = config.ANILIST_RATE = (10 ** 6, 1)
+    pairs = [({"title": f"Anime {i}", "ttid": fake_ttid(i), "year": "2001", "rating": "7.0"},
+              {"title": f"Аниме {i}"}) for i in range(count)]
+    result = measure("enrichment", size, pairs,
+                     lambda batch: main.enrich_anime(batch, config, 1), 100)
+    result["unit"] = "records"
+    return [result]
+
+
+def bench_omdb(size, limit, workdir):
+    count = min(size, limit)
+    config = omdb.AnimeConfig(delay=0.01, workers=8)
+    config.OMDB_API_KEY = "bench"
+    config.RATE = (10 ** 6, 1)
+    config.DAILY_LIMIT = 10 ** 9
+    config.CATALOG_FILE = None
+    ttids = [fake_ttid(i) for i in range(count)]
+
+    def run(batch):
+        run_dir = Path(tempfile.mkdtemp(dir=workdir))
+        config.INPUT_FILE = str(run_dir / "ttids.json")
+        config.OUTPUT_FILE = str(run_dir / "full.json")
+        config.JOURNAL_FILE = str(run_dir / "full.jsonl")
+        config.QUOTA_FILE = str(run_dir / "quota.json")
+        config.CACHE_FILE = str(run_dir / "cache.sqlite")
+        with open(config.INPUT_FILE, "w", encoding="utf-8") as f:
+            json.dump([{"ttid": ttid} for ttid in batch], f)
+        omdb.process_ttids(config)
+
+    saved = omdb.save_to_mongodb
+    omdb.save_to_mongodb = lambda data, cfg, prune=False: None
+    try:
+        result = measure("process_ttids", size, ttids, run, count)
+    finally:
+        omdb.save_to_mongodb = saved
+    result["unit"] = "ttids"
+    return [result]
+
+
+def bench_sink(size, mongo_uri):
+    config = SimpleNamespace(MONGODB_URI=mongo_uri, DB_NAME="anime_bench", COLLECTION_NAME=f"sink_{size}")
+    if mongo_uri:
+        from pymongo import MongoClient
+
+        client = MongoClient(mongo_uri)
+        client[config.DB_NAME][config.COLLECTION_NAME].drop()
+    else:
+        client = MemoryClient()
+
+    records = make_catalog_records(size)
+    results = [
+        measure("sink_initial", size, records, lambda batch: sync_to_mongodb(batch, config, client=client), 1000),
+        measure("sink_unchanged", size, records, lambda batch: sync_to_mongodb(batch, config, client=client), 1000),
+    ]
+    for record in records[:50]:
+        record["TMDbRating"] = 9.9
+    results.append(measure("sink_50_changed", size, records,
+                           lambda batch: sync_to_mongodb(batch, config, client=client), 1000))
+    if mongo_uri:
+        client[config.DB_NAME][config.COLLECTION_NAME].drop()
+    client.close()
+    for result in results:
+        result["unit"] = "records"
+    return results
+
+
+def load_fixtures(directory):
+    if not directory:
+        return None
+    return [path.read_text(encoding="utf-8") for path in sorted(Path(directory).glob("*.html"))] or None
+
+
+def print_report(results):
+    print(f"{'бенчмарк':<18} {'размер':>8} {'элементов':>10} {'в секунду':>20} {'p50, мс':>10} {'p95, мс':>10} "
+          f"{'RSS, МБ':>9}")
+    for r in results:
+        rss = f"{r['rss_mb']:>9.1f}" if r.get("rss_mb") is not None else f"{'':>9}"
+        print(f"{r['name']:<18} {r['size']:>8} {r['items']:>10} {r['throughput']:>11.0f} {r['unit'] + '/с':<8} "
+              f"{r['p50_ms']:>10.2f} {r['p95_ms']:>10.2f} {rss}")
+
+
+def compare_with_baseline(results, baseline_file, tolerance):
+    """Сравнивает пропускную способность с сохранённым прогоном; возвращает список регрессий."""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {(r["name"], r["size"]): r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        old = baseline.get((r["name"], r["size"]))
+        if old and r["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append(f"{r['name']} @ {r['size']}: {old['throughput']:.0f} → {r['throughput']:.0f} "
+                               f"{r['unit']}/с")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки конвейера")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Размеры каталога")
+    parser.add_argument("--network-limit", type=int, default=2000,
+                        help="Максимум записей для стадий, идущих через локальный HTTP-сервер")
+    parser.add_argument("--only", nargs="+", choices=["parse", "catalog", "files", "enrichment", "omdb", "sink"],
+                        help="Запустить только выбранные группы")
+    parser.add_argument("--fixtures", help="Каталог с сохранёнными страницами поиска IMDb (*.html)")
+    parser.add_argument("--mongo-uri", help="Настоящий mongod вместо коллекции в памяти")
+    parser.add_argument("--json", help="Сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое падение пропускной способности")
+    args = parser.parse_args()
+
+    groups = set(args.only or ["parse", "catalog", "files", "enrichment", "omdb", "sink"])
+    fixtures = load_fixtures(args.fixtures)
+    random.seed(0)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir, stand_in_server():
+        # Переводы тегов и жанров (available_*.json) ищутся относительно текущего каталога
+        os.chdir(Path(__file__).resolve().parent)
+        for size in args.sizes:
+            print(f"Размер {size}...", file=sys.stderr)
+            # Сами функции много печатают; на время замеров вывод отключается
+            with contextlib.redirect_stdout(io.StringIO()):
+                if "parse" in groups:
+                    results += bench_parse(size, fixtures)
+                if "catalog" in groups:
+                    results += bench_catalog(size)
+                if "files" in groups:
+                    results += bench_catalog_files(size, workdir)
+                if "enrichment" in groups:
+                    results += bench_enrichment(size, args.network_limit)
+                if "omdb" in groups:
+                    results += bench_omdb(size, args.network_limit, workdir)
+                if "sink" in groups:
+                    results += bench_sink(size, args.mongo_uri)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,95 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.firefox.service import Service
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from webdriver_manager.firefox import GeckoDriverManager
+
+# Где запоминается путь к скачанному geckodriver между запусками
+GECKODRIVER_CACHE_FILE = Path(__file__).with_name(".geckodriver_path")
+
+MORE_BUTTON_XPATH = "//span[contains(text(), '50 more')]/ancestor::button"
+
+# Настройки облегчённого профиля: без картинок, шрифтов, медиа и сторонних трекеров
+LEAN_PREFERENCES = {
+    "permissions.default.image": 2,
+    "gfx.downloadable_fonts.enabled": False,
+    "browser.display.use_document_fonts": 0,
+    "media.autoplay.default": 5,
+    "media.autoplay.blocking_policy": 2,
+    "media.video_stats.enabled": False,
+    "browser.contentblocking.category": "strict",
+    "privacy.trackingprotection.enabled": True,
+    "privacy.trackingprotection.socialtracking.enabled": True,
+    "network.cookie.cookieBehavior": 1,
+    "network.http.speculative-parallel-limit": 0,
+    "network.prefetch-next": False,
+    "browser.cache.disk.enable": False,
+}
+
+# Асинхронный скрипт: завершается, как только элементов на странице станет больше arguments[0]
+WAIT_FOR_ITEMS_JS = """
+const count = arguments[0];
+const done = arguments[arguments.length - 1];
+const current = () => document.querySelectorAll('li.ipc-metadata-list-summary-item').length;
+if (current() > count) {
+    done(current());
+    return;
+}
+const observer = new MutationObserver(() => {
+    const total = current();
+    if (total > count) {
+        observer.disconnect();
+        done(total);
+    }
+});
+observer.observe(document.body, {childList: true, subtree: true});
+"""
+
+
+@lru_cache(maxsize=None)
+def geckodriver_path():
+    """Путь к geckodriver: из GECKODRIVER_PATH, из сохранённого пути или, в крайнем случае, после скачивания."""
+    env_path = os.getenv("GECKODRIVER_PATH")
+    if env_path and Path(env_path).exists():
+        return env_path
+
+    if GECKODRIVER_CACHE_FILE.exists():
+        cached_path = GECKODRIVER_CACHE_FILE.read_text(encoding="utf-8").strip()
+        if Path(cached_path).exists():
+            return cached_path
+
+    path = GeckoDriverManager().install()
+    GECKODRIVER_CACHE_FILE.write_text(path, encoding="utf-8")
+    return path
+
+
+def create_driver(language, lean=False):
+    """Запускает Firefox; в облегчённом режиме — headless и с урезанным профилем."""
+    options = Options()
+    options.set_preference("intl.accept_languages", language)
+    if lean:
+        options.add_argument("-headless")
+        for name, value in LEAN_PREFERENCES.items():
+            options.set_preference(name, value)
+    service = Service(geckodriver_path())
+    return webdriver.Firefox(service=service, options=options)
+
+
+def click_more(driver, timeout=10):
+    """Нажимает кнопку "50 more" через JavaScript, без ожидания прокрутки."""
+    next_button = WebDriverWait(driver, timeout).until(
+        EC.presence_of_element_located((By.XPATH, MORE_BUTTON_XPATH))
+    )
+    driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", next_button)
+
+
+def wait_for_more_items(driver, count, timeout=15):
+    """Ждёт по сигналу MutationObserver, пока элементов станет больше `count`; возвращает их новое число."""
+    driver.set_script_timeout(timeout)
+    return driver.execute_async_script(WAIT_FOR_ITEMS_JS, count)
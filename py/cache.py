@@ -0,0 +1,166 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from httpclient import get_client
+from metrics import METRICS
+
+DAY = 24 * 60 * 60
+
+# Время жизни записей по умолчанию для каждого источника (секунды)
+DEFAULT_TTL = {
+    "tmdb": 7 * DAY,
+    "anilist": 7 * DAY,
+    "omdb": 30 * DAY,
+    "imdb": 30 * DAY,
+    "images": 30 * DAY,  # Соответствия ссылка → файл зеркала картинок; после истечения — условный запрос
+    "tmdb_ids": 365 * DAY,  # Соответствия TTID → TMDB id практически не меняются
+}
+
+# Параметры, которые не должны попадать в ключ кэша
+SECRET_PARAMS = {"api_key", "apikey"}
+
+
+def make_key(method, url, params=None, body=None):
+    """Строит нормализованный ключ запроса (без API-ключей, с отсортированными параметрами)."""
+    params = {k: v for k, v in (params or {}).items() if k not in SECRET_PARAMS}
+    payload = json.dumps([method.upper(), url, params, body], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class HttpCache:
+    """Локальный кэш HTTP-ответов в SQLite с TTL по источникам и вытеснением давно неиспользуемых записей."""
+
+    def __init__(self, path="http_cache.sqlite", ttl=None, max_entries=100_000):
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, source TEXT, value TEXT, expires REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        # Валидаторы для условных запросов (ETag / Last-Modified); в старых файлах кэша этих столбцов нет
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE responses ADD COLUMN {column} TEXT")
+        self._conn.commit()
+
+    def get(self, source, key):
+        """Возвращает сохранённый ответ или None, если его нет или он устарел."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                self.misses[source] += 1
+                METRICS.inc("cache_misses_total", source=source)
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits[source] += 1
+        METRICS.inc("cache_hits_total", source=source)
+        return json.loads(row[0])
+
+    def get_entry(self, source, key):
+        """Возвращает сохранённый ответ вместе с валидаторами, даже если он устарел: (value, etag, last_modified)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, etag, last_modified FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def set(self, source, key, value, etag=None, last_modified=None):
+        """Сохраняет ответ с TTL источника и при переполнении удаляет самые старые записи."""
+        now = time.time()
+        ttl = self.ttl.get(source, DAY)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, source, value, expires, accessed, etag, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, source, json.dumps(value, ensure_ascii=False), now + ttl, now, etag, last_modified),
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed LIMIT max(0, (SELECT COUNT(*) FROM responses) - ?))",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        """Счётчики попаданий и промахов по источникам."""
+        sources = set(self.hits) | set(self.misses)
+        return {source: {"hits": self.hits[source], "misses": self.misses[source]} for source in sorted(sources)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cached_request(cache, source, method, url, params=None, json_body=None, limiter=None, cacheable=None,
+                   client=None, budget=None, revalidate=False):
+    """Выполняет HTTP-запрос и возвращает JSON, используя кэш, если он передан.
+
+    Запрос идёт через общий клиент источника (см. httpclient.py): при 429/5xx, сетевой ошибке
+    или разомкнутом автомате бросается UpstreamError, а не возвращается пустой ответ.
+    В кэш попадают только успешные (200) ответы, для которых `cacheable(data)` истинно.
+    Бюджет `budget` (DailyBudget) и лимитер расходуются только на реальные сетевые запросы, по одному на попытку.
+    При `revalidate` запрос уходит в сеть даже при свежей записи в кэше, но условный
+    (If-None-Match / If-Modified-Since): на ответ 304 возвращается сохранённое значение.
+    """
+    key = make_key(method, url, params, json_body)
+    entry = None
+    headers = {}
+    if cache is not None and revalidate:
+        entry = cache.get_entry(source, key)
+        if entry is not None:
+            _, etag, last_modified = entry
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+    elif cache is not None:
+        cached = cache.get(source, key)
+        if cached is not None:
+            return cached
+
+    def before_attempt():
+        # Бюджет и лимитер расходуются на каждую попытку, включая повторы клиента при 429/5xx
+        if budget is not None:
+            budget.consume()
+        if limiter:
+            with METRICS.timer("rate_limit_wait_seconds", source=source):
+                limiter.acquire()
+
+    response = (client or get_client(source)).request(method, url, before_attempt=before_attempt, params=params,
+                                                      json=json_body, headers=headers or None)
+    if response.status_code == 304 and entry is not None:
+        value, etag, last_modified = entry
+        cache.set(source, key, value, response.headers.get("ETag", etag),
+                  response.headers.get("Last-Modified", last_modified))
+        return value
+    data = response.json()
+
+    if cache is not None and response.status_code == 200 and (cacheable is None or cacheable(data)):
+        cache.set(source, key, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return data
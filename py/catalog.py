@@ -0,0 +1,52 @@
+# Поля с названиями, по которым ищется запись каталога
+TITLE_FIELDS = ("TitleEng", "TitleRu")
+
+
+def normalize_title(title):
+    """Ключ поиска по названию: без пробелов по краям и без учёта регистра."""
+    return title.strip().casefold() if title else None
+
+
+class CatalogIndex:
+    """Индекс каталога аниме: поиск по TTID и названию за O(1) и следующий свободный ID.
+
+    Загружается один раз и обновляется на месте при добавлении новых записей.
+    """
+
+    def __init__(self, records=None):
+        self.records = []
+        self._by_ttid = {}
+        self._by_title = {}
+        self._max_id = 0
+        for record in records or []:
+            self.add(record)
+
+    def add(self, record):
+        """Добавляет запись в каталог и обновляет индексы."""
+        self.records.append(record)
+        self._by_ttid[record["TTID"]] = record
+        for field in TITLE_FIELDS:
+            title = normalize_title(record.get(field))
+            if title:
+                self._by_title.setdefault(title, record)
+        if isinstance(record.get("ID"), int):
+            self._max_id = max(self._max_id, record["ID"])
+
+    def __contains__(self, ttid):
+        return ttid in self._by_ttid
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, ttid):
+        """Возвращает запись по TTID или None."""
+        return self._by_ttid.get(ttid)
+
+    def find_by_title(self, title):
+        """Возвращает запись по английскому или русскому названию (без учёта регистра) или None."""
+        return self._by_title.get(normalize_title(title))
+
+    @property
+    def next_id(self):
+        """Следующий свободный ID."""
+        return self._max_id + 1
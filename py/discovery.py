@@ -0,0 +1,477 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from html import unescape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+
+from cache import make_key
+from metrics import METRICS
+from ratelimit import TokenBucket
+
+IMDB_SEARCH_URL = "https://m.imdb.com/search/title/"
+IMDB_SEARCH_PARAMS = {
+    "title_type": "feature,tv_movie,tv_special,video,tv_series,tv_miniseries",
+    "interests": "in0000027",
+}
+IMDB_TITLE_TYPES = IMDB_SEARCH_PARAMS["title_type"].split(",")
+IMDB_TITLE_URL = "https://m.imdb.com/title/{ttid}/"
+IMDB_SEARCH_PAGE_URL = IMDB_SEARCH_URL + "?" + "&".join(f"{k}={v}" for k, v in IMDB_SEARCH_PARAMS.items())
+
+# Инкрементальный обход: стабильный порядок "сначала новые", чтобы новые тайтлы были в начале выдачи
+IMDB_DELTA_PARAMS = {"sort": "release_date,desc"}
+IMDB_DELTA_PAGE_URL = IMDB_SEARCH_PAGE_URL + "&" + "&".join(f"{k}={v}" for k, v in IMDB_DELTA_PARAMS.items())
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+
+NEXT_DATA_RE = re.compile(r'<script id="__NEXT_DATA__" type="application/json">(.*?)</script>', re.S)
+HERO_TITLE_RE = re.compile(r'data-testid="hero__primary-text"[^>]*>([^<]+)<')
+PAGE_TITLE_RE = re.compile(r"<title>(.*?)</title>", re.S)
+SUMMARY_ITEMS = SoupStrainer("li", class_="ipc-metadata-list-summary-item")
+
+
+def extract_year(text):
+    """Извлекает год из строки."""
+    year_match = re.search(r'(\d{4})(?:–)?(?:\s*)?(?:\d{4})?', text)
+    return year_match.group(1) if year_match else None
+
+
+def clean_title(title):
+    """Удаляет номера в начале названия, например, '1. Naruto' → 'Naruto'."""
+    return re.sub(r"^\d+\.\s*", "", title).strip()
+
+
+def parse_summary_item(item):
+    """Разбирает элемент списка результатов поиска IMDb (BeautifulSoup) в словарь или None."""
+    link = item.find("a")
+    ttid_match = re.search(r"/title/(tt\d+)/", link["href"]) if link else None
+    if not ttid_match:
+        return None
+
+    title_tag = item.find("h3")
+    year_span = item.find("span", class_="dli-title-metadata-item")
+    rating_tag = item.find("span", class_="ipc-rating-star--rating")
+    return {
+        "title": clean_title(title_tag.text.strip()) if title_tag else None,
+        "ttid": ttid_match.group(1),
+        "rating": rating_tag.text.strip() if rating_tag else "N/A",
+        "year": extract_year(year_span.text.strip()) if year_span else None,
+    }
+
+
+# Возвращает из страницы только элементы, начиная с индекса arguments[0], уже в виде простых данных,
+# чтобы не передавать и не разбирать в Python всю страницу на каждой итерации "50 more"
+EXTRACT_ITEMS_JS = """
+const items = document.querySelectorAll('li.ipc-metadata-list-summary-item');
+const text = (item, selector) => {
+    const node = item.querySelector(selector);
+    return node ? node.textContent.trim() : null;
+};
+const result = [];
+for (let i = arguments[0]; i < items.length; i++) {
+    const link = items[i].querySelector('a');
+    result.push({
+        href: link ? link.getAttribute('href') : null,
+        title: text(items[i], 'h3'),
+        year: text(items[i], 'span.dli-title-metadata-item'),
+        rating: text(items[i], 'span.ipc-rating-star--rating')
+    });
+}
+return {total: items.length, items: result};
+"""
+
+
+def extract_new_items(driver, start):
+    """Извлекает из открытой в Selenium страницы элементы результатов, начиная с индекса `start`.
+
+    Возвращает общее число элементов на странице и список словарей title/ttid/rating/year
+    (None для элементов без TTID).
+    """
+    extracted = driver.execute_script(EXTRACT_ITEMS_JS, start)
+    items = []
+    for raw in extracted["items"]:
+        ttid_match = re.search(r"/title/(tt\d+)/", raw["href"]) if raw["href"] else None
+        if not ttid_match:
+            items.append(None)
+            continue
+        items.append({
+            "title": clean_title(raw["title"]) if raw["title"] else None,
+            "ttid": ttid_match.group(1),
+            "rating": raw["rating"] or "N/A",
+            "year": extract_year(raw["year"]) if raw["year"] else None,
+        })
+    return extracted["total"], items
+
+
+def _parse_next_data(html):
+    """Достаёт результаты поиска из встроенного JSON Next.js (без разбора DOM)."""
+    match = NEXT_DATA_RE.search(html)
+    if not match:
+        return None
+    try:
+        page_props = json.loads(match.group(1))["props"]["pageProps"]
+        title_items = page_props["searchResults"]["titleResults"]["titleListItems"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    items = []
+    for entry in title_items:
+        title = entry.get("titleText")
+        if isinstance(title, dict):
+            title = title.get("text")
+        rating = (entry.get("ratingSummary") or {}).get("aggregateRating")
+        year = entry.get("releaseYear")
+        if isinstance(year, dict):
+            year = year.get("year")
+        items.append({
+            "title": clean_title(title) if title else None,
+            "ttid": entry.get("titleId"),
+            "rating": str(rating) if rating else "N/A",
+            "year": str(year) if year else None,
+        })
+    return items
+
+
+def parse_search_page(html):
+    """Разбирает страницу результатов поиска IMDb в список словарей title/ttid/rating/year."""
+    items = _parse_next_data(html)
+    if items is not None:
+        return items
+    soup = BeautifulSoup(html, "html.parser", parse_only=SUMMARY_ITEMS)
+    return [item for item in map(parse_summary_item, soup.find_all("li")) if item]
+
+
+class DiscoveryUnavailable(Exception):
+    """IMDb не отдал разбираемую страницу поиска по HTTP."""
+
+
+def iter_search_pages(language, page_size=250, max_pages=40, rate=(1, 1), params=None):
+    """Постранично загружает поиск IMDb по HTTP и отдаёт списки новых (ещё не встречавшихся) элементов.
+
+    Бросает DiscoveryUnavailable, если уже первая страница не загрузилась или не разобралась.
+    Генератор возвращает (StopIteration.value) True, если выдача закончилась, и False, если обход
+    прервала ошибка или лимит max_pages.
+    """
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Language": language})
+    limiter = TokenBucket(*rate)
+    search_params = {**IMDB_SEARCH_PARAMS, **(params or {}), "count": page_size}
+
+    seen = set()
+    for page in range(max_pages):
+        with METRICS.timer("rate_limit_wait_seconds", source="imdb_search"):
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.get(IMDB_SEARCH_URL, params={**search_params, "start": page * page_size + 1},
+                                   timeout=30)
+            METRICS.record_request("imdb_search", response.status_code, time.perf_counter() - started,
+                                   len(response.content))
+            response.raise_for_status()
+        except Exception as e:
+            if not isinstance(e, requests.HTTPError):
+                METRICS.record_request("imdb_search", "error", time.perf_counter() - started)
+            if not page:
+                raise DiscoveryUnavailable(e)
+            print(f"Ошибка загрузки страницы поиска IMDb: {e}")
+            return False
+
+        items = parse_search_page(response.text)
+        if not items and page == 0:
+            raise DiscoveryUnavailable("страница поиска не содержит результатов")
+
+        fresh = [item for item in items if item["ttid"] and item["ttid"] not in seen]
+        print(f"Страница {page + 1}: {len(items)} элементов, новых {len(fresh)}")
+        if not fresh:
+            return True
+        seen.update(item["ttid"] for item in fresh)
+        yield fresh
+    return False
+
+
+def discover_http(language, known, needed_count, page_size=250, max_pages=40, rate=(1, 1), params=None):
+    """Собирает новые тайтлы со страниц поиска IMDb обычными HTTP-запросами, без браузера.
+
+    `known` — любой контейнер с поддержкой `in` (индекс каталога, множество TTID).
+    Возвращает None, если IMDb не отдал разбираемую страницу, чтобы вызывающий код
+    мог переключиться на Selenium.
+    """
+    found = []
+    try:
+        for items in iter_search_pages(language, page_size, max_pages, rate, params):
+            for item in items:
+                if item["ttid"] in known:
+                    print(f"Пропуск {item['ttid']} - уже существует")
+                    continue
+                if not item["title"]:
+                    print("Пропуск: заголовок не найден")
+                    continue
+                found.append(item)
+                if len(found) >= needed_count:
+                    return found
+    except DiscoveryUnavailable as e:
+        print(f"Страница поиска IMDb недоступна ({e}), нужен браузер")
+        return None
+    return found
+
+
+def build_shards(first_year=1900, last_year=None, span=5, title_types=IMDB_TITLE_TYPES):
+    """Делит поиск на непересекающиеся шарды: каждый тип тайтла × диапазон лет выхода."""
+    last_year = last_year or date.today().year + 2
+    shards = []
+    for title_type in title_types:
+        for start in range(first_year, last_year + 1, span):
+            end = min(start + span - 1, last_year)
+            shards.append({"title_type": title_type, "release_date": f"{start}-01-01,{end}-12-31"})
+    return shards
+
+
+# Событие остановки шардов в процессе пула (задаётся инициализатором ProcessPoolExecutor)
+_shard_stop = None
+
+
+def _init_shard_worker(stop):
+    global _shard_stop
+    _shard_stop = stop
+
+
+def crawl_shard(language, params, page_size=250, max_pages=40):
+    """Обходит один шард (выполняется в отдельном процессе) и возвращает найденные элементы.
+
+    Обход прерывается после текущей страницы, если discover_sharded уже набрал нужное число тайтлов.
+    """
+    found = []
+    try:
+        for items in iter_search_pages(language, page_size, max_pages, params=params):
+            found.extend(item for item in items if item["title"])
+            if _shard_stop is not None and _shard_stop.is_set():
+                break
+    except DiscoveryUnavailable as e:
+        print(f"Шард {params} недоступен: {e}")
+    return found
+
+
+def discover_sharded(language, known, needed_count, shards=None, processes=None, page_size=250, max_pages=40):
+    """Параллельно обходит шарды поиска IMDb в пуле процессов, объединяя и дедуплицируя TTID на лету.
+
+    Снимает ограничение одной цепочки "50 more": каждый шард листается отдельно.
+    Возвращает None, если ни один шард ничего не вернул (IMDb недоступен по HTTP).
+    """
+    shards = shards or build_shards()
+    found = []
+    seen = set()
+    stop = multiprocessing.Event()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_shard_worker, initargs=(stop,)) as pool:
+        futures = [pool.submit(crawl_shard, language, params, page_size, max_pages) for params in shards]
+        answered = False
+        for future in as_completed(futures):
+            items = future.result()
+            answered = answered or bool(items)
+            for item in items:
+                if item["ttid"] in seen:
+                    continue
+                seen.add(item["ttid"])
+                if item["ttid"] in known:
+                    continue
+                found.append(item)
+            print(f"Шардов готово: {sum(f.done() for f in futures)} из {len(futures)}, новых тайтлов {len(found)}")
+            if len(found) >= needed_count:
+                # Очередные шарды отменяются, а запущенные останавливаются после текущей страницы,
+                # иначе выход из пула ждал бы, пока каждый дочитает свои max_pages страниц
+                stop.set()
+                pool.shutdown(wait=False, cancel_futures=True)
+                break
+    if not answered:
+        return None
+    return found[:needed_count]
+
+
+class DeltaFrontier:
+    """Граница инкрементального обхода, сохраняемая между запусками (файл JSON, ключ — язык обхода).
+
+    Хранит TTID первой страницы последнего завершённого обхода (boundary) и признак того,
+    что прошлый обход дошёл до границы (complete). Если прошлый обход дошёл, остановиться можно
+    на первой странице из одних известных TTID; если его прервал лимит, ниже могли остаться
+    непросмотренные тайтлы, поэтому обход идёт до страницы со старой границей.
+    Пока границы нет (первый обход), её роль играет сам каталог: обход останавливается на странице
+    из одних известных TTID или на лимите страниц, и первая страница становится границей.
+    Новое состояние записывается только вызовом save() — после того как найденное сохранено.
+    """
+
+    def __init__(self, path, key):
+        self.path = Path(path)
+        self.key = key
+        state = self._read().get(key, {})
+        self.boundary = set(state.get("boundary", []))
+        self.complete = state.get("complete", False)
+        self._pending = None
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except ValueError:
+            print(f"Ошибка при чтении {self.path}, граница обхода сброшена")
+            return {}
+
+    def reached(self, ttids, known):
+        """Дошёл ли обход до уже просмотренной части выдачи на странице с TTID `ttids`."""
+        if any(ttid in self.boundary for ttid in ttids):
+            return True
+        return (self.complete or not self.boundary) and all(ttid in known for ttid in ttids)
+
+    def finish(self, head, complete, limit_reached=False):
+        """Запоминает итог обхода: TTID первой страницы и дошёл ли обход до границы.
+
+        `limit_reached` — обход упёрся в лимит страниц; без сохранённой границы это тоже
+        завершает первый обход, иначе граница не появилась бы, пока выдача не кончится.
+        """
+        complete = complete or (limit_reached and not self.boundary)
+        self._pending = {
+            "boundary": list(head) if complete else sorted(self.boundary),
+            "complete": complete,
+            "updated": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+
+    def save(self):
+        if self._pending is None:
+            return
+        state = self._read()
+        state[self.key] = self._pending
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp_path.write_text(json.dumps(state, ensure_ascii=False, indent=4), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+        self.boundary = set(self._pending["boundary"])
+        self.complete = self._pending["complete"]
+        self._pending = None
+
+
+def iter_delta_pages(language, known, frontier, page_size=50, max_pages=40, rate=(1, 1)):
+    """Листает выдачу IMDb от новых к старым и отдаёт новые тайтлы постранично, пока не дойдёт до границы.
+
+    Обход считается завершённым, только если он дошёл до границы или выдача закончилась; если его
+    оборвали max_pages, ошибка или потребитель (например, набрал нужное количество), граница не сдвигается.
+    Исключение — первый обход без границы: его завершает и лимит max_pages (см. DeltaFrontier.finish).
+    Бросает DiscoveryUnavailable, как iter_search_pages.
+    """
+    head = None
+    complete = False
+    limit_reached = False
+    fetched = 0
+    pages = iter_search_pages(language, page_size, max_pages, rate, params=IMDB_DELTA_PARAMS)
+    try:
+        while True:
+            try:
+                items = next(pages)
+            except StopIteration as stop:
+                complete = bool(stop.value)
+                limit_reached = not complete and fetched >= max_pages
+                break
+            fetched += 1
+            ttids = [item["ttid"] for item in items]
+            if head is None:
+                head = ttids
+            fresh = [item for item in items if item["ttid"] not in known and item["title"]]
+            if fresh:
+                yield fresh
+            if frontier.reached(ttids, known):
+                print("Дошли до границы прошлого обхода")
+                complete = True
+                break
+    finally:
+        pages.close()
+        if head is not None:
+            frontier.finish(head, complete, limit_reached)
+
+
+def discover_delta(language, known, needed_count, frontier, page_size=50, max_pages=40, rate=(1, 1)):
+    """Инкрементальный обход: собирает тайтлы, появившиеся с прошлого запуска (см. iter_delta_pages).
+
+    Возвращает None, если IMDb не отдал разбираемую страницу (нужен браузер).
+    """
+    found = []
+    pages = iter_delta_pages(language, known, frontier, page_size, max_pages, rate)
+    try:
+        for items in pages:
+            for item in items:
+                found.append(item)
+                if len(found) >= needed_count:
+                    pages.close()
+                    return found
+    except DiscoveryUnavailable as e:
+        print(f"Страница поиска IMDb недоступна ({e}), нужен браузер")
+        return None
+    return found
+
+
+def parse_title_page(html):
+    """Достаёт локализованное название со страницы тайтла IMDb."""
+    match = NEXT_DATA_RE.search(html)
+    if match:
+        try:
+            title = json.loads(match.group(1))["props"]["pageProps"]["aboveTheFoldData"]["titleText"]["text"]
+            if title:
+                return title
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    match = HERO_TITLE_RE.search(html)
+    if match:
+        return unescape(match.group(1)).strip()
+
+    # Запасной вариант: "<title>Название (TV Series 2024– ) - IMDb</title>"
+    match = PAGE_TITLE_RE.search(html)
+    if match:
+        return re.sub(r"\s*(\([^)]*\))?\s*-\s*IMDb\s*$", "", unescape(match.group(1))).strip() or None
+    return None
+
+
+def create_title_session(language):
+    """HTTP-сессия для страниц тайтлов IMDb на языке `language`."""
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Language": language})
+    return session
+
+
+def fetch_localized_title(ttid, language, session, limiter=None, cache=None):
+    """Получает название тайтла на языке сессии; найденные названия кэшируются (источник "imdb")."""
+    url = IMDB_TITLE_URL.format(ttid=ttid)
+    key = make_key("GET", url, {"language": language})
+    cached = cache.get("imdb", key) if cache is not None else None
+    if cached is not None:
+        return cached
+    try:
+        if limiter:
+            with METRICS.timer("rate_limit_wait_seconds", source="imdb"):
+                limiter.acquire()
+        started = time.perf_counter()
+        response = session.get(url, timeout=30)
+        METRICS.record_request("imdb", response.status_code, time.perf_counter() - started, len(response.content))
+        response.raise_for_status()
+        title = parse_title_page(response.text)
+    except Exception as e:
+        print(f"Ошибка получения названия для {ttid}: {e}")
+        return None
+    if title and cache is not None:
+        cache.set("imdb", key, title)
+    return title
+
+
+def get_localized_titles(ttids, language, cache=None, workers=8, rate=(5, 1)):
+    """Параллельно получает названия тайтлов на языке `language` по их TTID.
+
+    Возвращает словарь {ttid: название}; для неудачных запросов значение None.
+    """
+    session = create_title_session(language)
+    limiter = TokenBucket(*rate)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        titles = pool.map(lambda ttid: fetch_localized_title(ttid, language, session, limiter, cache), ttids)
+        return dict(zip(ttids, titles))
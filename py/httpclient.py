@@ -0,0 +1,235 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+# Ответы, после которых запрос имеет смысл повторить: лимит запросов и временные ошибки сервера
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Таймауты (соединение, чтение) в секундах: без них упавший источник держит поток бесконечно
+DEFAULT_TIMEOUT = (5, 30)
+
+# Настройки клиентов по источникам; источники не из списка получают значения по умолчанию
+UPSTREAMS = {
+    "tmdb": {"pool_size": 16},
+    "anilist": {"pool_size": 4, "max_delay": 90.0},  # AniList просит ждать до минуты при 429
+    "omdb": {"pool_size": 8},
+    "images": {"pool_size": 16, "retries": 2},
+}
+
+
+class UpstreamError(Exception):
+    """Источник временно недоступен (429, 5xx, сеть, открытый автомат).
+
+    Данные по запросу неизвестны, а не пусты: такой результат нельзя сохранять как «нет данных».
+    """
+
+    def __init__(self, source, message, retry_after=None):
+        super().__init__(f"{source}: {message}")
+        self.source = source
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamError):
+    """Автомат источника разомкнут: запрос не отправлялся."""
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для одного источника.
+
+    После `threshold` подряд неудачных запросов (каждый — уже с повторами) источник считается
+    упавшим, и в течение `reset_timeout` секунд запросы к нему сразу завершаются CircuitOpen.
+    Затем пропускается один пробный запрос: успех замыкает автомат, неудача размыкает его снова.
+    """
+
+    def __init__(self, source, threshold=5, reset_timeout=30.0):
+        self.source = source
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Проверяет, можно ли отправить запрос; иначе бросает CircuitOpen."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self._probing:
+                METRICS.inc("circuit_rejected_total", source=self.source)
+                raise CircuitOpen(self.source, "автомат разомкнут", max(0.0, remaining))
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"Источник {self.source} снова доступен")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self):
+        """Снимает пробный запрос, который так и не был отправлен (например, исчерпан бюджет)."""
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                if not self._probing:
+                    print(f"Источник {self.source} недоступен, запросы приостановлены на {self.reset_timeout:.0f} с")
+                    METRICS.inc("circuit_open_total", source=self.source)
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def remaining(self):
+        """Сколько секунд автомат ещё будет разомкнут (0 — запросы пропускаются)."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+def retry_after_seconds(value):
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата); None, если заголовка нет или он некорректен."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """HTTP-клиент одного источника: пул keep-alive соединений, таймауты, повторы и автомат.
+
+    429 и 5xx повторяются до `retries` раз с паузой из Retry-After или экспоненциальной с разбросом;
+    пауза длиннее `max_delay` не выдерживается — запрос сразу считается неудачным. Остальные ответы
+    (включая 404 и прочие 4xx) возвращаются вызывающему как есть. Если повторы не помогли,
+    бросается UpstreamError.
+    """
+
+    def __init__(self, source, pool_size=10, timeout=DEFAULT_TIMEOUT, retries=3, backoff=1.0, max_delay=60.0,
+                 breaker=None):
+        self.source = source
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker(source)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _delay(self, attempt):
+        return min(self.max_delay, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def request(self, method, url, before_attempt=None, **kwargs):
+        """Выполняет запрос с повторами; `before_attempt` вызывается перед каждой попыткой (лимитер, бюджет).
+
+        Повторы одного запроса не проверяют автомат заново: в полуоткрытом состоянии они
+        относятся к тому же пробному запросу.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        self.breaker.before()
+        sent = False
+        # Любой выход после before() должен закончиться success(), failure() или release(),
+        # иначе пробный запрос так и останется «в полёте» и автомат не замкнётся
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    METRICS.inc("retries_total", source=self.source)
+                if before_attempt is not None:
+                    before_attempt()
+                sent = True
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.RequestException as e:
+                    METRICS.record_request(self.source, "error", time.perf_counter() - started)
+                    error = UpstreamError(self.source, f"{type(e).__name__}: {e}")
+                    delay = self._delay(attempt)
+                else:
+                    METRICS.record_request(self.source, response.status_code, time.perf_counter() - started,
+                                           len(response.content))
+                    if response.status_code not in RETRY_STATUSES:
+                        self.breaker.success()
+                        return response
+                    retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                    error = UpstreamError(self.source, f"HTTP {response.status_code}", retry_after)
+                    # Retry-After соблюдается точно, разброс только сверху, чтобы потоки не проснулись разом
+                    delay = retry_after + random.uniform(0, self.backoff) if retry_after is not None \
+                        else self._delay(attempt)
+                if attempt == self.retries or delay > self.max_delay:
+                    break
+                time.sleep(delay)
+        except BaseException:
+            if sent:
+                self.breaker.failure()
+            else:
+                self.breaker.release()
+            raise
+        self.breaker.failure()
+        raise error
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(source):
+    """Общий для процесса клиент источника `source` (создаётся при первом обращении)."""
+    with _clients_lock:
+        client = _clients.get(source)
+        if client is None:
+            client = _clients[source] = HttpClient(source, **UPSTREAMS.get(source, {}))
+        return client
+
+
+def wait_for_upstreams(sources):
+    """Ждёт, пока автоматы источников `sources` не пропустят пробный запрос."""
+    with _clients_lock:
+        breakers = [client.breaker for source, client in _clients.items() if source in sources]
+    delay = max([breaker.remaining() for breaker in breakers], default=0.0)
+    if delay:
+        print(f"Ждём {delay:.0f} с восстановления источников: {', '.join(sources)}")
+        time.sleep(delay)
+
+
+class RetryQueue:
+    """Задания, отложенные из-за недоступности источника; повторяются в конце запуска."""
+
+    def __init__(self):
+        self._items = []
+        self._lock = threading.Lock()
+
+    def defer(self, item, error):
+        with self._lock:
+            self._items.append(item)
+        METRICS.inc("deferred_total", source=getattr(error, "source", "unknown"))
+
+    def drain(self):
+        with self._lock:
+            items, self._items = self._items, []
+        return items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,123 @@
+import json
+import time
+import tracemalloc
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+# Типы TMDB в индексе: 0 — неизвестно, 1 — сериал, 2 — фильм
+TMDB_TYPES = {"TV": 1, "tv": 1, "MOVIE": 2, "movie": 2}
+TMDB_TYPE_NAMES = {1: "tv", 2: "movie"}
+
+
+def _ttid_number(ttid):
+    """'tt0123456' → 123456; None, если строка не похожа на TTID."""
+    if isinstance(ttid, str) and ttid.startswith("tt") and ttid[2:].isdigit():
+        return int(ttid[2:])
+    return None
+
+
+def _int_id(value):
+    try:
+        return int(value) if value not in (None, "") else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+class IdMap:
+    """Компактный индекс соответствий IMDb → AniList / MAL / TMDB.
+
+    Данные хранятся в отсортированных по номеру TTID массивах `array`, поиск — бинарный.
+    Загружает JSON-список записей вида
+    {"imdb_id": "tt...", "anilist_id": ..., "mal_id": ..., "themoviedb_id": ..., "type": "TV"}
+    (формат дампа anime-lists; поле tmdb_type, если есть, имеет приоритет над type).
+    """
+
+    def __init__(self, entries=()):
+        rows = []
+        for entry in entries:
+            imdb_ids = entry.get("imdb_id")
+            # В некоторых дампах imdb_id — строка с несколькими TTID через запятую
+            for ttid in (imdb_ids.split(",") if isinstance(imdb_ids, str) else [imdb_ids]):
+                number = _ttid_number(ttid and ttid.strip())
+                if number is None:
+                    continue
+                tmdb_type = entry.get("tmdb_type") or entry.get("type")
+                rows.append((number, _int_id(entry.get("anilist_id")), _int_id(entry.get("mal_id")),
+                             _int_id(entry.get("themoviedb_id")), TMDB_TYPES.get(tmdb_type, 0)))
+
+        # При дубликатах TTID остаётся первая запись
+        rows.sort(key=lambda row: row[0])
+        self._imdb = array("I")
+        self._anilist = array("I")
+        self._mal = array("I")
+        self._tmdb = array("I")
+        self._tmdb_type = array("B")
+        for row in rows:
+            if self._imdb and self._imdb[-1] == row[0]:
+                continue
+            self._imdb.append(row[0])
+            self._anilist.append(row[1])
+            self._mal.append(row[2])
+            self._tmdb.append(row[3])
+            self._tmdb_type.append(row[4])
+
+    @classmethod
+    def load(cls, path):
+        """Загружает индекс из JSON-файла; если файла нет, возвращает пустой индекс."""
+        try:
+            if Path(path).exists():
+                with open(path, 'r', encoding='utf-8') as f:
+                    return cls(json.load(f))
+            print(f"Файл соответствий {path} не найден, все тайтлы пойдут через поиск")
+        except Exception as e:
+            print(f"Ошибка при чтении {path}: {e}")
+        return cls()
+
+    def __len__(self):
+        return len(self._imdb)
+
+    def _index(self, ttid):
+        number = _ttid_number(ttid)
+        if number is None:
+            return None
+        i = bisect_left(self._imdb, number)
+        return i if i < len(self._imdb) and self._imdb[i] == number else None
+
+    def __contains__(self, ttid):
+        return self._index(ttid) is not None
+
+    def get(self, ttid):
+        """Возвращает {"anilist_id", "mal_id", "tmdb_id", "tmdb_type"} по TTID или None (0 в id → None)."""
+        i = self._index(ttid)
+        if i is None:
+            return None
+        return {
+            "anilist_id": self._anilist[i] or None,
+            "mal_id": self._mal[i] or None,
+            "tmdb_id": self._tmdb[i] or None,
+            "tmdb_type": TMDB_TYPE_NAMES.get(self._tmdb_type[i]),
+        }
+
+    def nbytes(self):
+        """Объём памяти под массивы индекса (байт)."""
+        return sum(a.itemsize * len(a) for a in (self._imdb, self._anilist, self._mal, self._tmdb, self._tmdb_type))
+
+
+def measure_load(path):
+    """Загружает индекс и печатает время загрузки, размер и пиковое потребление памяти."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    id_map = IdMap.load(path)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Индекс соответствий: {len(id_map)} записей, загрузка {elapsed:.3f} с, "
+          f"массивы {id_map.nbytes() / 1024:.0f} КБ, пик при загрузке {peak / 1024 / 1024:.1f} МБ")
+    return id_map
+
+
+if __name__ == "__main__":
+    import sys
+
+    measure_load(sys.argv[1] if len(sys.argv) > 1 else "anime_id_map.json")
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from metrics import METRICS
+
+
+class Journal:
+    """Append-only журнал результатов в формате JSONL с пакетным fsync.
+
+    Каждая строка — {"ttid": ..., "data": {...} | null}; null означает, что тайтл
+    обработан, но данных по нему нет. Множество `done` служит контрольной точкой:
+    при перезапуске уже обработанные TTID пропускаются.
+    """
+
+    def __init__(self, path, fsync_every=50):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.done = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+        if self.path.exists():
+            for entry in self._read():
+                self.done.add(entry["ttid"])
+        self._file = open(self.path, "a", encoding="utf-8")
+        if self._file.tell() and not self._ends_with_newline():
+            self._file.write("\n")
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Недописанная строка после аварийного завершения
+                    print(f"Пропуск повреждённой строки журнала {self.path}")
+
+    def append(self, ttid, data):
+        """Дописывает результат по TTID; fsync выполняется раз в `fsync_every` записей."""
+        line = json.dumps({"ttid": ttid, "data": data}, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            METRICS.inc("bytes_written_total", len(line.encode("utf-8")), target="journal")
+            self.done.add(ttid)
+            self._pending += 1
+            if self._pending >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def flush(self):
+        """Сбрасывает буфер на диск."""
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def compact(self):
+        """Сворачивает журнал (последняя запись по TTID побеждает) и возвращает итоговые данные.
+
+        Сам журнал атомарно перезаписывается без дубликатов.
+        """
+        self.flush()
+        entries = {}
+        for entry in self._read():
+            entries[entry["ttid"]] = entry
+
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+        return [entry["data"] for entry in entries.values() if entry["data"]]
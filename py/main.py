@@ -1,38 +1,94 @@
 import json
-import re
 import time
-import requests
-from selenium import webdriver
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.options import Options
+from datetime import datetime, timezone
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.firefox import GeckoDriverManager
-from bs4 import BeautifulSoup
-from pymongo import MongoClient
 from dotenv import load_dotenv
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from ratelimit import TokenBucket
+from pymongo import ASCENDING, DESCENDING, TEXT
+from sink import sync_to_mongodb, update_facets
+from catalog import CatalogIndex
+from snapshot import load_snapshot_catalog, save_catalog
+from idmap import measure_load
+from browser import click_more, create_driver, wait_for_more_items
+from vocab import get_vocabulary
+from metrics import METRICS, StageProfiler, profile_stage
+from mirror import mirror_images
+from discovery import (IMDB_DELTA_PAGE_URL, IMDB_SEARCH_PAGE_URL, DeltaFrontier, discover_delta, discover_http,
+                       discover_sharded, extract_new_items, get_localized_titles)
+from cache import HttpCache, cached_request, make_key
+from httpclient import RetryQueue, UpstreamError, wait_for_upstreams
 
 # Load environment variables
 load_dotenv()
 
 
 class AnimeConfig:
-    def __init__(self, limit=1500, delay=2):
+    def __init__(self, limit=1500, delay=2, workers=8):
         self.LIMIT = limit
         self.DELAY = delay
+        # "http" — без браузера, "sharded" — по шардам в пуле процессов, "selenium" — через Firefox,
+        # "delta" — только новое: от свежих релизов до границы прошлого обхода (см. DeltaFrontier)
+        self.DISCOVERY_BACKEND = "http"
+        self.DELTA_PAGE_SIZE = 50  # Размер страницы для "delta": ежедневному запуску хватает пары страниц
+        self.DELTA_LIMIT = 200  # Сколько новинок искать за один запуск "delta" (LIMIT на этот режим не влияет)
+        self.LEAN_CRAWL = True  # Selenium: headless, без картинок/медиа/трекеров и без фиксированных пауз
+        self.DISCOVERY_PROCESSES = None  # Процессов для "sharded" (None — по числу ядер)
+        self.BILINGUAL_CRAWL = False  # True — отдельный полный обход IMDb на русском
+        self.WORKERS = workers  # Количество параллельных запросов к каждому API при обогащении
+        self.TMDB_RATE = (40, 1)  # Не больше 40 запросов в секунду к TMDB
+        self.ANILIST_RATE = (90, 60)  # Не больше 90 запросов в минуту к AniList
+        self.ANILIST_BATCH_SIZE = 10  # Количество тайтлов в одном GraphQL-запросе к AniList
+        self.RETRY_ROUNDS = 2  # Сколько раз повторять тайтлы, отложенные из-за недоступности TMDB/AniList
         self.TMDB_API_KEY = os.getenv('TMDB_API_KEY')
         self.MONGODB_URI = os.getenv('MONGODB_URI')
         self.DB_NAME = os.getenv('DB_NAME', 'anime_db')
         self.COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'anime_list')
+        self.MONGODB_PRUNE = os.getenv('MONGODB_PRUNE') == '1'  # Разовая очистка коллекции: дубликаты и документы не из набора
         self.JSON_FILE = "anime_list.json"
-
-
-def get_tmdb_data(title, config):
+        self.SNAPSHOT_FILE = "anime_list.bin"  # Компактный снимок каталога рядом с JSON (см. snapshot.py)
+        self.CACHE_FILE = "http_cache.sqlite"  # Локальный кэш ответов TMDB/AniList/OMDb
+        self.ID_MAP_FILE = "anime_id_map.json"  # Соответствия IMDb → AniList/MAL/TMDB (дамп anime-lists)
+        self.FRONTIER_FILE = "anime_list_frontier.json"  # Граница инкрементального обхода ("delta")
+        self.METRICS_FILE = os.getenv('METRICS_FILE')  # *.prom — формат Prometheus, иначе JSON
+        self.PROFILE_DIR = os.getenv('PROFILE_DIR')  # Каталог для cProfile по стадиям (None — без профилирования)
+        self.MIRROR_IMAGES = False  # Скачивать постеры и фоны в локальное зеркало (см. mirror.py)
+        self.IMAGES_DIR = "images"  # Каталог зеркала картинок
+        self.IMAGE_RATE = (20, 1)  # Не больше 20 запросов в секунду к image.tmdb.org
+        self.REFRESH_BUDGET = 200  # refresh.py: сколько записей обновлять за запуск (≈ запросов к TMDB)
+
+
+TMDB_BASE_URL = "https://api.themoviedb.org/3"
+
+# Преобразование статуса на русский (сериалы и фильмы)
+TMDB_STATUS_MAPPING = {
+    "Returning Series": "Выходит",
+    "Planned": "Запланировано",
+    "In Production": "В производстве",
+    "Ended": "Завершён",
+    "Canceled": "Отменён",
+    "Pilot": "Пилот",
+    "Released": "Вышел",
+    "Post Production": "Постпродакшн",
+    "Rumored": "Слухи"
+}
+
+TMDB_EMPTY = {
+    "overview_ru": "",
+    "poster_path": None,
+    "backdrop_path": None,
+    "tmdb_rating": 0,
+    "status": "Неизвестно"
+}
+
+
+def get_tmdb_data(title, config, limiter=None, cache=None, revalidate=False):
     """Получает дополнительные данные с TMDB API (постеры, описания, рейтинги, статус)."""
-    base_url = "https://api.themoviedb.org/3"
+    base_url = TMDB_BASE_URL
     search_url = f"{base_url}/search/tv"
 
     params = {
@@ -43,8 +99,7 @@ def get_tmdb_data(title, config):
 
     try:
         # Поиск сериала
-        response = requests.get(search_url, params=params)
-        data = response.json()
+        data = cached_request(cache, "tmdb", "GET", search_url, params=params, limiter=limiter, revalidate=revalidate)
 
         if data.get("results") and len(data["results"]) > 0:
             anime = data["results"][0]
@@ -53,21 +108,11 @@ def get_tmdb_data(title, config):
             # Получение детальной информации о сериале
             if series_id:
                 details_url = f"{base_url}/tv/{series_id}"
-                details_response = requests.get(details_url,
-                                                params={"api_key": config.TMDB_API_KEY, "language": "ru-RU"})
-                details = details_response.json()
-
-                # Преобразование статуса на русский
-                status_mapping = {
-                    "Returning Series": "Выходит",
-                    "Planned": "Запланировано",
-                    "In Production": "В производстве",
-                    "Ended": "Завершён",
-                    "Canceled": "Отменён",
-                    "Pilot": "Пилот"
-                }
+                details = cached_request(cache, "tmdb", "GET", details_url,
+                                         params={"api_key": config.TMDB_API_KEY, "language": "ru-RU"},
+                                         limiter=limiter, revalidate=revalidate)
 
-                status = status_mapping.get(details.get("status"), details.get("status", "Неизвестно"))
+                status = TMDB_STATUS_MAPPING.get(details.get("status"), details.get("status", "Неизвестно"))
 
                 return {
                     "overview_ru": anime.get("overview", ""),
@@ -78,39 +123,122 @@ def get_tmdb_data(title, config):
                     "tmdb_rating": anime.get("vote_average", 0),
                     "status": status
                 }
+    except UpstreamError:
+        raise
     except Exception as e:
         print(f"Error fetching TMDB data for {title}: {e}")
 
-    return {
-        "overview_ru": "",
-        "poster_path": None,
-        "backdrop_path": None,
-        "tmdb_rating": 0,
-        "status": "Неизвестно"
-    }
+    return dict(TMDB_EMPTY)
+
+
+def resolve_tmdb_id(ttid, config, limiter=None, cache=None, id_map=None):
+    """Находит TMDB id по TTID и возвращает ("tv" | "movie", id) или None.
+
+    Сначала проверяется локальный индекс соответствий, затем запомненные в кэше
+    результаты /find и только потом выполняется сам запрос /find.
+    """
+    ids = id_map.get(ttid) if id_map is not None else None
+    if ids and ids["tmdb_id"] and ids["tmdb_type"]:
+        return ids["tmdb_type"], ids["tmdb_id"]
+
+    key = make_key("GET", "tmdb_id", {"ttid": ttid})
+    if cache is not None:
+        resolved = cache.get("tmdb_ids", key)
+        if resolved is not None:
+            return tuple(resolved)
+
+    data = cached_request(cache, "tmdb", "GET", f"{TMDB_BASE_URL}/find/{ttid}",
+                          params={"api_key": config.TMDB_API_KEY, "external_source": "imdb_id"}, limiter=limiter)
+    for media_type in ("tv", "movie"):
+        results = data.get(f"{media_type}_results") or []
+        if results:
+            resolved = (media_type, results[0]["id"])
+            if cache is not None:
+                cache.set("tmdb_ids", key, list(resolved))
+            return resolved
+    return None
+
+
+def get_tmdb_data_by_ttid(ttid, title, config, limiter=None, cache=None, id_map=None, revalidate=False):
+    """Получает данные TMDB по TTID (сериалы и фильмы).
+
+    TTID сопоставляется с TMDB id через /find, а детали и русские постеры приходят
+    одним запросом (append_to_response). Если TTID в TMDB не найден, выполняется
+    поиск по названию. При `revalidate` детали запрашиваются условным запросом в обход кэша.
+    Если TMDB временно недоступен, бросается UpstreamError, а не возвращаются пустые данные.
+    """
+    try:
+        resolved = resolve_tmdb_id(ttid, config, limiter, cache, id_map)
+        if resolved is None:
+            print(f"TMDB не знает {ttid}, ищем по названию {title}")
+            return get_tmdb_data(title, config, limiter, cache, revalidate)
+
+        media_type, tmdb_id = resolved
+        details = cached_request(cache, "tmdb", "GET", f"{TMDB_BASE_URL}/{media_type}/{tmdb_id}",
+                                 params={"api_key": config.TMDB_API_KEY, "language": "ru-RU",
+                                         "append_to_response": "images", "include_image_language": "ru,null"},
+                                 limiter=limiter, revalidate=revalidate)
+
+        # Предпочитаем постер с русской локализацией, если он есть
+        ru_posters = [image for image in (details.get("images") or {}).get("posters", [])
+                      if image.get("iso_639_1") == "ru"]
+        poster_path = ru_posters[0]["file_path"] if ru_posters else details.get("poster_path")
+        backdrop_path = details.get("backdrop_path")
+
+        return {
+            "overview_ru": details.get("overview", ""),
+            "poster_path": f"https://image.tmdb.org/t/p/w500{poster_path}" if poster_path else None,
+            "backdrop_path": f"https://image.tmdb.org/t/p/original{backdrop_path}" if backdrop_path else None,
+            "tmdb_rating": details.get("vote_average", 0),
+            "status": TMDB_STATUS_MAPPING.get(details.get("status"), details.get("status", "Неизвестно"))
+        }
+    except UpstreamError:
+        raise
+    except Exception as e:
+        print(f"Error fetching TMDB data for {ttid}: {e}")
 
+    return dict(TMDB_EMPTY)
 
-def extract_year(text):
-    """Извлекает год из строки."""
-    year_match = re.search(r'(\d{4})(?:–)?(?:\s*)?(?:\d{4})?', text)
-    return year_match.group(1) if year_match else None
 
+def new_titles_needed(config, catalog_size):
+    """Сколько новых тайтлов искать: до LIMIT записей, а в режиме "delta" — до DELTA_LIMIT за запуск."""
+    if config.DISCOVERY_BACKEND == "delta":
+        return config.DELTA_LIMIT
+    return config.LIMIT - catalog_size
 
-def clean_title(title):
-    """Удаляет номера в начале названия, например, '1. Naruto' → 'Naruto'."""
-    return re.sub(r"^\d+\.\s*", "", title).strip()
 
+def get_anime_list(config, language, catalog, needed_count, frontier=None):
+    """Собирает новые аниме с IMDb: по HTTP, а если это не удалось — через Selenium.
 
-def get_anime_list(config, language, existing_anime, needed_count):
+    С `frontier` (режим "delta") выдача идёт от новых к старым и обход останавливается на границе прошлого.
+    """
     if needed_count <= 0:
         return []
 
-    url = "https://m.imdb.com/search/title/?title_type=feature,tv_movie,tv_special,video,tv_series,tv_miniseries&interests=in0000027"
-    options = Options()
-    options.set_preference("intl.accept_languages", language)
-    service = Service(GeckoDriverManager().install())
-    driver = webdriver.Firefox(service=service, options=options)
-    driver.get(url)
+    if frontier is not None:
+        anime_list = discover_delta(language, catalog, needed_count, frontier, page_size=config.DELTA_PAGE_SIZE)
+    elif config.DISCOVERY_BACKEND == "sharded":
+        anime_list = discover_sharded(language, catalog, needed_count, processes=config.DISCOVERY_PROCESSES)
+    elif config.DISCOVERY_BACKEND == "http":
+        anime_list = discover_http(language, catalog, needed_count)
+    else:
+        anime_list = None
+
+    if anime_list is not None:
+        METRICS.inc("stage_records_total", len(anime_list), stage="discover")
+        print(f"Всего собрано {len(anime_list)} элементов")
+        return anime_list
+    if config.DISCOVERY_BACKEND != "selenium":
+        print("Переключаемся на Selenium...")
+
+    return get_anime_list_selenium(config, language, catalog, needed_count, frontier)
+
+
+def get_anime_list_selenium(config, language, catalog, needed_count, frontier=None):
+    url = IMDB_DELTA_PAGE_URL if frontier is not None else IMDB_SEARCH_PAGE_URL
+    driver = create_driver(language, lean=config.LEAN_CRAWL)
+    with METRICS.timer("selenium_load_seconds", step="open"):
+        driver.get(url)
     anime_list = []
     attempts = 0
     max_attempts = 10
@@ -120,54 +248,60 @@ def get_anime_list(config, language, existing_anime, needed_count):
         EC.presence_of_element_located((By.CLASS_NAME, "ipc-metadata-list-summary-item"))
     )
 
+    processed = 0
+    head = None
+    reached = False
     while len(anime_list) < needed_count and attempts < max_attempts:
-        # Парсим текущую страницу
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        anime_items = soup.find_all("li", class_="ipc-metadata-list-summary-item")
-        print(f"Попытка {attempts + 1}: найдено {len(anime_items)} элементов на странице")
-
-        # Обрабатываем только новые элементы
-        new_items = anime_items[len(anime_list):]
+        # Забираем со страницы только элементы, появившиеся после прошлой итерации
+        total, new_items = extract_new_items(driver, processed)
+        processed = total
+        print(f"Попытка {attempts + 1}: найдено {total} элементов на странице")
         print(f"Новых элементов для обработки: {len(new_items)}")
+        if frontier is not None:
+            ttids = [item["ttid"] for item in new_items if item]
+            head = ttids if head is None else head
+            reached = frontier.reached(ttids, catalog)
         for item in new_items:
-            ttid_match = re.search(r"/title/(tt\d+)/", item.find("a")["href"]) if item.find("a") else None
-            if not ttid_match:
+            if not item:
                 print("Пропуск: TTID не найден")
                 continue
-            ttid = ttid_match.group(1)
+            ttid = item["ttid"]
 
-            if is_anime_exists(ttid, existing_anime):
+            if is_anime_exists(ttid, catalog):
                 print(f"Пропуск {ttid} - уже существует")
                 continue
 
-            title_tag = item.find("h3")
-            if not title_tag:
+            if not item["title"]:
                 print("Пропуск: заголовок не найден")
                 continue
-            raw_title = title_tag.text.strip()
-            title = clean_title(raw_title)
-
-            year_span = item.find("span", class_="dli-title-metadata-item")
-            year = extract_year(year_span.text.strip()) if year_span else None
 
-            rating_tag = item.find("span", class_="ipc-rating-star--rating")
-            rating = rating_tag.text.strip() if rating_tag else "N/A"
-
-            anime_list.append({
-                "title": title,
-                "ttid": ttid,
-                "rating": rating,
-                "year": year
-            })
-            print(f"Добавлено: {title} (TTID: {ttid})")
+            anime_list.append(item)
+            METRICS.inc("stage_records_total", stage="discover")
+            print(f"Добавлено: {item['title']} (TTID: {ttid})")
 
             if len(anime_list) >= needed_count:
                 break
 
         print(f"Собрано {len(anime_list)} из {needed_count}")
+        if reached:
+            print("Дошли до границы прошлого обхода")
+            break
 
-        if len(anime_list) < needed_count:
+        if len(anime_list) < needed_count and config.LEAN_CRAWL:
+            try:
+                # Без фиксированных пауз: ждём ровно до появления новых элементов
+                with METRICS.timer("selenium_load_seconds", step="more"):
+                    click_more(driver)
+                    loaded = wait_for_more_items(driver, processed)
+                print(f"Подгружено: {loaded} элементов")
+                attempts += 1
+            except Exception as e:
+                METRICS.inc("errors_total", stage="selenium")
+                print(f"Не удалось подгрузить больше данных: {e}")
+                break
+        elif len(anime_list) < needed_count:
             try:
+                load_started = time.perf_counter()
                 print("Ищем кнопку '50 more'...")
                 next_button = WebDriverWait(driver, 10).until(
                     EC.element_to_be_clickable((By.XPATH, "//span[contains(text(), '50 more')]/ancestor::button"))
@@ -179,19 +313,53 @@ def get_anime_list(config, language, existing_anime, needed_count):
                 next_button.click()
                 print("Ждём подгрузки новых элементов...")
                 WebDriverWait(driver, 15).until(
-                    lambda driver: len(driver.find_elements(By.CLASS_NAME, "ipc-metadata-list-summary-item")) > len(anime_items)
+                    lambda driver: len(driver.find_elements(By.CLASS_NAME, "ipc-metadata-list-summary-item")) > processed
                 )
                 time.sleep(config.DELAY)
+                METRICS.observe("selenium_load_seconds", time.perf_counter() - load_started, step="more")
                 attempts += 1
             except Exception as e:
+                METRICS.inc("errors_total", stage="selenium")
                 print(f"Не удалось подгрузить больше данных: {e}")
                 break
 
     print(f"Всего собрано {len(anime_list)} элементов")
     driver.quit()
+    if frontier is not None and head is not None:
+        frontier.finish(head, reached, limit_reached=attempts >= max_attempts)
     return anime_list
 
 
+def get_bilingual_list(config, catalog, needed_count, cache=None, frontier=None):
+    """Собирает новые аниме и возвращает пары (англ., рус.), сопоставленные по TTID.
+
+    По умолчанию список собирается один раз на английском, а русские названия
+    запрашиваются отдельно по каждому TTID. При BILINGUAL_CRAWL выполняются два
+    полных обхода, как раньше, но результаты всё равно объединяются по TTID.
+    Инкрементальный обход (`frontier`) выполняется только на английском: граница у каталога одна.
+    """
+    print("Сбор данных на английском...")
+    anime_english = get_anime_list(config, "en-US, en", catalog, needed_count, frontier)
+
+    if config.BILINGUAL_CRAWL and frontier is None:
+        print("Сбор данных на русском...")
+        anime_russian = get_anime_list(config, "ru-RU, ru", catalog, needed_count)
+        titles_ru = {anime["ttid"]: anime["title"] for anime in anime_russian}
+    else:
+        print("Получение русских названий по TTID...")
+        titles_ru = get_localized_titles([anime["ttid"] for anime in anime_english], "ru-RU, ru", cache,
+                                         workers=config.WORKERS)
+
+    pairs = []
+    for eng in anime_english:
+        title_ru = titles_ru.get(eng["ttid"])
+        if not title_ru:
+            print(f"Русское название для {eng['ttid']} не найдено, используем английское")
+            title_ru = eng["title"]
+        pairs.append((eng, {"title": title_ru}))
+    return pairs
+
+
 def load_existing_anime(json_file):
     """Загружает существующие аниме из JSON файла."""
     try:
@@ -204,141 +372,370 @@ def load_existing_anime(json_file):
         return []
 
 
-def is_anime_exists(ttid, existing_anime):
-    """Проверяет, существует ли аниме с данным TTID."""
-    return any(anime["TTID"] == ttid for anime in existing_anime)
-
-
-def save_to_mongodb(data, config):
-    """Сохраняет данные в MongoDB Atlas."""
-    try:
-        client = MongoClient(config.MONGODB_URI)
-        db = client[config.DB_NAME]
-        collection = db[config.COLLECTION_NAME]
-
-        collection.delete_many({})
-        collection.insert_many(data)
-        print(f"Успешно сохранено {len(data)} записей в MongoDB")
-
-    except Exception as e:
-        print(f"Ошибка при сохранении в MongoDB: {e}")
-    finally:
-        client.close()
+def load_catalog(json_file):
+    """Загружает каталог из JSON файла и строит по нему индекс."""
+    return CatalogIndex(load_existing_anime(json_file))
 
 
-def get_anilist_tags_and_genres(title, tags_file="available_tags.json", genres_file="available_genres.json"):
-    """Получает и фильтрует теги, жанры и количество серий с AniList, используя переводы из JSON-файлов."""
-    query = '''
-    query ($search: String) {
-        Media (search: $search, type: ANIME) {
+def is_anime_exists(ttid, catalog):
+    """Проверяет, существует ли аниме с данным TTID."""
+    return ttid in catalog
+
+
+# Индексы под запросы сервера в js/: по TTID, жанрам, тегам, году и рейтингу, плюс поиск по названиям
+CATALOG_INDEXES = [
+    ([("TTID", ASCENDING)], {"unique": True}),
+    ([("Genres", ASCENDING), ("TMDbRating", DESCENDING)], {}),
+    ([("Tags", ASCENDING), ("TMDbRating", DESCENDING)], {}),
+    ([("Year", ASCENDING), ("TMDbRating", DESCENDING)], {}),
+    ([("TMDbRating", DESCENDING)], {}),
+    ([("TitleEng", TEXT), ("TitleRu", TEXT)], {"default_language": "none", "name": "titles_text"}),
+]
+
+# Поля карточки в списках лучших
+TOP_RATED_FIELDS = {"_id": 0, "TTID": 1, "TitleEng": 1, "TitleRu": 1, "Year": 1, "TMDbRating": 1, "PosterRu": 1}
+
+# Сводки для каталога: число тайтлов по жанрам, тегам и годам и списки лучших по рейтингу TMDB
+CATALOG_FACETS = {
+    "genres": [{"$unwind": "$Genres"}, {"$sortByCount": "$Genres"}],
+    "tags": [{"$unwind": "$Tags"}, {"$sortByCount": "$Tags"}],
+    "years": [{"$group": {"_id": "$Year", "count": {"$sum": 1}}}, {"$sort": {"_id": -1}}],
+    "top_rated": [
+        {"$match": {"TMDbRating": {"$gt": 0}}},
+        {"$sort": {"TMDbRating": -1, "TTID": 1}},
+        {"$limit": 100},
+        {"$project": TOP_RATED_FIELDS},
+    ],
+    "top_rated_by_genre": [
+        {"$match": {"TMDbRating": {"$gt": 0}}},
+        {"$unwind": "$Genres"},
+        {"$group": {"_id": "$Genres", "items": {"$topN": {
+            "n": 20,
+            "sortBy": {"TMDbRating": -1, "TTID": 1},
+            "output": {field: f"${field}" for field, shown in TOP_RATED_FIELDS.items() if shown},
+        }}}},
+        {"$sort": {"_id": 1}},
+    ],
+}
+
+
+def save_to_mongodb(data, config, client=None, prune=False):
+    """Сохраняет данные в MongoDB Atlas (инкрементально, по TTID) и обновляет сводки каталога.
+
+    `prune=True` допустим только для полного каталога (см. sync_to_mongodb).
+    """
+    counts = sync_to_mongodb(data, config, key="TTID", client=client, indexes=CATALOG_INDEXES, prune=prune)
+    if counts["inserted"] or counts["updated"] or counts["removed"]:
+        update_facets(config, CATALOG_FACETS, client=client)
+    return counts
+
+
+ANILIST_URL = 'https://graphql.anilist.co'
+
+# Переводы тегов и жанров AniList на русский
+TAGS_FILE = "available_tags.json"
+GENRES_FILE = "available_genres.json"
+
+ANILIST_FIELDS = '''
             tags {
                 name
             }
             genres
             episodes
-        }
+        '''
+
+ANILIST_QUERY = '''
+    query ($search: String) {
+        Media (search: $search, type: ANIME) {%s}
     }
-    '''
-    variables = {'search': title}
-    url = 'https://graphql.anilist.co'
+    ''' % ANILIST_FIELDS
 
-    try:
-        response = requests.post(url, json={'query': query, 'variables': variables})
-        data = response.json()
+ANILIST_ID_QUERY = '''
+    query ($id: Int) {
+        Media (id: $id, type: ANIME) {%s}
+    }
+    ''' % ANILIST_FIELDS
 
-        if 'data' in data and 'Media' in data['data']:
-            media = data['data']['Media']
 
-            # Загрузка доступных тегов и жанров с переводами
-            available_tags = load_json(tags_file)
-            available_genres = load_json(genres_file)
+def anilist_lookup(title, anilist_id=None):
+    """Запрос и переменные для AniList: по точному id, если он известен, иначе поиск по названию."""
+    if anilist_id:
+        return ANILIST_ID_QUERY, {'id': anilist_id}
+    return ANILIST_QUERY, {'search': title}
 
-            # Получаем теги, жанры и количество серий
-            all_tags = [tag['name'] for tag in media.get('tags', [])]
-            all_genres = media.get('genres', [])
-            episodes = media.get('episodes', None)  # None, если данных нет
 
-            # Фильтрация и перевод тегов и жанров
-            filtered_tags = [available_tags.get(tag, tag) for tag in all_tags if tag in available_tags]
-            filtered_genres = [available_genres.get(genre, genre) for genre in all_genres if genre in available_genres]
+def parse_anilist_media(media, tags_file=TAGS_FILE, genres_file=GENRES_FILE):
+    """Фильтрует теги и жанры одного тайтла AniList и возвращает их коды из словарей переводов.
 
-            return {
-                "tags": filtered_tags,
-                "genres": filtered_genres,
-                "episodes": episodes
-            }
+    На русский коды переводятся только при сборке итоговой записи (build_anime_record).
+    """
+    if not media:
+        return {"tags": [], "genres": [], "episodes": None}
+
+    # Получаем теги, жанры и количество серий
+    all_tags = [tag['name'] for tag in media.get('tags', [])]
+    all_genres = media.get('genres', [])
+    episodes = media.get('episodes', None)  # None, если данных нет
+
+    return {
+        "tags": get_vocabulary(tags_file).encode(all_tags),
+        "genres": get_vocabulary(genres_file).encode(all_genres),
+        "episodes": episodes
+    }
+
+
+def get_anilist_tags_and_genres(title, tags_file=TAGS_FILE, genres_file=GENRES_FILE,
+                                limiter=None, cache=None, anilist_id=None):
+    """Получает и фильтрует теги, жанры и количество серий с AniList, используя переводы из JSON-файлов."""
+    query, variables = anilist_lookup(title, anilist_id)
+
+    try:
+        data = cached_request(cache, "anilist", "POST", ANILIST_URL,
+                              json_body={'query': query, 'variables': variables}, limiter=limiter)
+
+        if 'data' in data and 'Media' in data['data']:
+            return parse_anilist_media(data['data']['Media'], tags_file, genres_file)
+    except UpstreamError:
+        raise
     except Exception as e:
         print(f"Ошибка при получении данных с AniList для {title}: {e}")
 
     return {"tags": [], "genres": [], "episodes": None}
 
-def load_json(file_path):
-    """Загружает JSON-файл."""
-    try:
-        if Path(file_path).exists():
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        print(f"Ошибка при чтении {file_path}: {e}")
-        return {}
+
+def build_anilist_batch_query(lookups):
+    """Строит GraphQL-запрос с псевдонимами Media (m0, m1, ...) по списку переменных поиска."""
+    declarations = []
+    fields = []
+    for i, variables in enumerate(lookups):
+        if 'id' in variables:
+            declarations.append(f"$s{i}: Int")
+            fields.append(f"\n        m{i}: Media (id: $s{i}, type: ANIME) {{{ANILIST_FIELDS}}}")
+        else:
+            declarations.append(f"$s{i}: String")
+            fields.append(f"\n        m{i}: Media (search: $s{i}, type: ANIME) {{{ANILIST_FIELDS}}}")
+    return f"query ({', '.join(declarations)}) {{{''.join(fields)}\n    }}"
+
+
+def get_anilist_batch(titles, tags_file=TAGS_FILE, genres_file=GENRES_FILE,
+                      limiter=None, cache=None, anilist_ids=None, refresh=False):
+    """Получает данные AniList для нескольких тайтлов одним запросом.
+
+    Тайтлы с известным `anilist_ids[i]` запрашиваются по id, остальные — поиском по названию.
+    Возвращает результаты в порядке `titles`. Ответы кэшируются по каждому тайтлу
+    под тем же ключом, что и в get_anilist_tags_and_genres. Тайтлы, для которых
+    AniList вернул ошибку (кроме «не найдено»), запрашиваются повторно по одному.
+    Если AniList временно недоступен, бросается UpstreamError для всего пакета.
+    При `refresh` кэш не читается, а только обновляется (GraphQL не поддерживает условные запросы).
+    """
+    lookups = list(zip(titles, anilist_ids or [None] * len(titles)))
+    results = {}
+    keys = {}
+    pending = []
+    for lookup in dict.fromkeys(lookups):
+        query, variables = anilist_lookup(*lookup)
+        keys[lookup] = make_key("POST", ANILIST_URL, body={'query': query, 'variables': variables})
+        cached = cache.get("anilist", keys[lookup]) if cache is not None and not refresh else None
+        if cached is not None:
+            results[lookup] = parse_anilist_media(cached['data']['Media'], tags_file, genres_file)
+        else:
+            pending.append(lookup)
+
+    retry = []
+    if pending:
+        try:
+            batch_variables = [anilist_lookup(*lookup)[1] for lookup in pending]
+            query = build_anilist_batch_query(batch_variables)
+            variables = {f"s{i}": next(iter(v.values())) for i, v in enumerate(batch_variables)}
+            data = cached_request(None, "anilist", "POST", ANILIST_URL,
+                                  json_body={'query': query, 'variables': variables}, limiter=limiter)
+            if not data.get('data'):
+                raise ValueError(data.get('errors', 'пустой ответ'))
+
+            # Псевдонимы с ошибками, отличными от 404 (тайтл не найден), повторяем по одному
+            failed = {error['path'][0] for error in data.get('errors', [])
+                      if error.get('path') and error.get('status') != 404}
+            for i, lookup in enumerate(pending):
+                if f"m{i}" in failed:
+                    retry.append(lookup)
+                    continue
+                media = data['data'].get(f"m{i}")
+                if cache is not None:
+                    cache.set("anilist", keys[lookup], {'data': {'Media': media}})
+                results[lookup] = parse_anilist_media(media, tags_file, genres_file)
+        except UpstreamError:
+            raise
+        except Exception as e:
+            print(f"Ошибка пакетного запроса к AniList ({len(pending)} тайтлов), запрашиваем по одному: {e}")
+            retry = pending
+
+    for title, anilist_id in retry:
+        results[(title, anilist_id)] = get_anilist_tags_and_genres(title, tags_file, genres_file, limiter,
+                                                                   None if refresh else cache, anilist_id)
+
+    return [results[lookup] for lookup in lookups]
+
+
+def tmdb_fields(tmdb_data):
+    """Поля записи аниме, которые берутся из TMDB."""
+    return {
+        "TMDbRating": tmdb_data["tmdb_rating"],
+        "Status": tmdb_data["status"],
+        "PosterRu": tmdb_data["poster_path"],
+        "Backdrop": tmdb_data["backdrop_path"],
+        "OverviewRu": tmdb_data["overview_ru"],
+    }
+
+
+def anilist_fields(anilist_data, tags_file=TAGS_FILE, genres_file=GENRES_FILE):
+    """Поля записи аниме, которые берутся из AniList (коды тегов и жанров переводятся на русский)."""
+    return {
+        "Episodes": anilist_data["episodes"],
+        "Tags": get_vocabulary(tags_file).decode(anilist_data["tags"]),
+        "Genres": get_vocabulary(genres_file).decode(anilist_data["genres"])
+    }
+
+
+def enriched_at():
+    """Отметка времени обогащения записи (UTC, ISO 8601)."""
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def build_anime_record(anime_id, eng, ru, tmdb_data, anilist_data, tags_file=TAGS_FILE, genres_file=GENRES_FILE):
+    """Собирает итоговую запись аниме из данных IMDb, TMDB и AniList."""
+    return {
+        "ID": anime_id,
+        "TitleEng": eng["title"],
+        "TitleRu": ru["title"],
+        "URL": f"https://m.imdb.com/title/{eng['ttid']}",
+        "TTID": eng["ttid"],
+        "Year": eng["year"],
+        "IMDbRating": eng["rating"],
+        **tmdb_fields(tmdb_data),
+        **anilist_fields(anilist_data, tags_file, genres_file),
+        "EnrichedAt": enriched_at()
+    }
+
+
+def fetch_enrichment(pairs, config, cache=None, id_map=None, retry_queue=None, profilers=None):
+    """Параллельно запрашивает данные TMDB и AniList для пар (англ., рус.).
+
+    У каждого API свой пул потоков и свой ограничитель скорости. Возвращает тройки
+    (пара, данные TMDB, данные AniList) в исходном порядке. Пары, для которых источник
+    был недоступен (UpstreamError), в результат не попадают и откладываются в `retry_queue`.
+    `profilers` — {"tmdb": StageProfiler, "anilist": StageProfiler}; сохраняет их вызывающий.
+    """
+    profilers = profilers or {}
+    tmdb_limiter = TokenBucket(*config.TMDB_RATE)
+    anilist_limiter = TokenBucket(*config.ANILIST_RATE, burst=5)
+    tmdb_fetch = profilers["tmdb"].wrap(get_tmdb_data_by_ttid) if "tmdb" in profilers else get_tmdb_data_by_ttid
+    anilist_fetch = profilers["anilist"].wrap(get_anilist_batch) if "anilist" in profilers else get_anilist_batch
+
+    with ThreadPoolExecutor(max_workers=config.WORKERS) as tmdb_pool, \
+            ThreadPoolExecutor(max_workers=config.WORKERS) as anilist_pool:
+        tmdb_futures = [tmdb_pool.submit(tmdb_fetch, eng["ttid"], eng["title"], config,
+                                         tmdb_limiter, cache, id_map)
+                        for eng, _ in pairs]
+        batch_size = config.ANILIST_BATCH_SIZE
+        anilist_ids = [(id_map.get(eng["ttid"]) or {}).get("anilist_id") if id_map is not None else None
+                       for eng, _ in pairs]
+        anilist_futures = [anilist_pool.submit(anilist_fetch, [eng["title"] for eng, _ in pairs[i:i + batch_size]],
+                                               limiter=anilist_limiter, cache=cache,
+                                               anilist_ids=anilist_ids[i:i + batch_size])
+                           for i in range(0, len(pairs), batch_size)]
+
+        fetched = []
+        for index, (pair, tmdb_future) in enumerate(zip(pairs, tmdb_futures)):
+            try:
+                anilist_data = anilist_futures[index // batch_size].result()[index % batch_size]
+                tmdb_data = tmdb_future.result()
+            except UpstreamError as e:
+                print(f"Отложено {pair[0]['title']} ({pair[0]['ttid']}): {e}")
+                if retry_queue is not None:
+                    retry_queue.defer(pair, e)
+                continue
+            fetched.append((pair, tmdb_data, anilist_data))
+    return fetched
+
+
+def enrich_anime(pairs, config, start_id, cache=None, id_map=None):
+    """Обогащает пары (англ., рус.) данными TMDB и AniList и собирает итоговые записи.
+
+    Тайтлы, для которых TMDB или AniList были недоступны, повторяются после восстановления
+    источников (до RETRY_ROUNDS раз); не получившиеся и после этого в каталог не попадают
+    и будут найдены заново при следующем запуске. ID присваиваются подряд в порядке готовности.
+    """
+    retry_queue = RetryQueue()
+    # Профили общие для первого прохода и повторов, иначе каждый повтор перезаписывал бы *.prof
+    profilers = {name: StageProfiler(name, config.PROFILE_DIR) for name in ("tmdb", "anilist")} \
+        if config.PROFILE_DIR else {}
+    fetched = fetch_enrichment(pairs, config, cache, id_map, retry_queue, profilers)
+    for attempt in range(config.RETRY_ROUNDS):
+        if not retry_queue:
+            break
+        wait_for_upstreams(("tmdb", "anilist"))
+        deferred = retry_queue.drain()
+        print(f"Повтор {attempt + 1}: {len(deferred)} отложенных тайтлов")
+        fetched += fetch_enrichment(deferred, config, cache, id_map, retry_queue, profilers)
+    for profiler in profilers.values():
+        profiler.dump()
+
+    new_data = []
+    for (eng, ru), tmdb_data, anilist_data in fetched:
+        new_data.append(build_anime_record(start_id + len(new_data), eng, ru, tmdb_data, anilist_data))
+        METRICS.inc("stage_records_total", stage="enrich")
+        print(f"Обогащено {len(new_data)} из {len(pairs)}: {eng['title']}")
+    if retry_queue:
+        print(f"Не удалось обогатить {len(retry_queue)} тайтлов: источники недоступны, повторим при следующем запуске")
+    return new_data, retry_queue.drain()
+
+
 # В основном скрипте добавляем загрузку тегов
 if __name__ == "__main__":
     config = AnimeConfig(limit=1500, delay=2)
 
     # Загружаем доступные теги и жанры
-    available_tags = load_json("available_tags.json")
-    available_genres = load_json("available_genres.json")
-    print(f"Загружено {len(available_tags)} доступных тегов")
-    print(f"Загружено {len(available_genres)} доступных жанров")
+    print(f"Загружено {len(get_vocabulary(TAGS_FILE))} доступных тегов")
+    print(f"Загружено {len(get_vocabulary(GENRES_FILE))} доступных жанров")
 
-    existing_anime = load_existing_anime(config.JSON_FILE)
-    print(f"Найдено {len(existing_anime)} существующих аниме")
+    catalog = load_snapshot_catalog(config.JSON_FILE, config.SNAPSHOT_FILE)
+    print(f"Найдено {len(catalog)} существующих аниме")
 
-    needed_count = config.LIMIT - len(existing_anime)
+    needed_count = new_titles_needed(config, len(catalog))
     print(f"Требуется найти {needed_count} новых аниме")
 
     if needed_count > 0:
-        print("Сбор данных на английском...")
-        anime_english = get_anime_list(config, "en-US, en", existing_anime, needed_count)
-
-        print("Сбор данных на русском...")
-        anime_russian = get_anime_list(config, "ru-RU, ru", existing_anime, needed_count)
-
-        new_data = []
-        for eng, ru in zip(anime_english, anime_russian):
-            # Получаем данные с TMDB
-            tmdb_data = get_tmdb_data(eng["title"], config)
-
-            # Получаем и фильтруем теги и жанры с AniList
-            print(f"Получение тегов и жанров для {eng['title']}...")
-            anilist_data = get_anilist_tags_and_genres(eng["title"])
-
-            new_data.append({
-                "ID": len(existing_anime) + len(new_data) + 1,
-                "TitleEng": eng["title"],
-                "TitleRu": ru["title"],
-                "URL": f"https://m.imdb.com/title/{eng['ttid']}",
-                "TTID": eng["ttid"],
-                "Year": eng["year"],
-                "IMDbRating": eng["rating"],
-                "TMDbRating": tmdb_data["tmdb_rating"],
-                "Status": tmdb_data["status"],
-                "PosterRu": tmdb_data["poster_path"],
-                "Backdrop": tmdb_data["backdrop_path"],
-                "OverviewRu": tmdb_data["overview_ru"],
-                "Episodes": anilist_data["episodes"],
-                "Tags": anilist_data["tags"],
-                "Genres": anilist_data["genres"]
-            })
-            time.sleep(config.DELAY)  # Задержка между запросами
-
-        combined_data = existing_anime + new_data
-
-        with open(config.JSON_FILE, "w", encoding="utf-8") as f:
-            json.dump(combined_data, f, ensure_ascii=False, indent=4)
-        print(f"Данные сохранены в {config.JSON_FILE} (всего {len(combined_data)} записей)")
-
-        save_to_mongodb(combined_data, config)
+        cache = HttpCache(config.CACHE_FILE)
+        frontier = DeltaFrontier(config.FRONTIER_FILE, "en-US, en") if config.DISCOVERY_BACKEND == "delta" else None
+        discover, discover_profiler = profile_stage("discover", get_bilingual_list, config.PROFILE_DIR)
+        pairs = discover(config, catalog, needed_count, cache, frontier)
+        if discover_profiler:
+            discover_profiler.dump()
+        id_map = measure_load(config.ID_MAP_FILE)
+        mapped = sum(1 for eng, _ in pairs if eng["ttid"] in id_map)
+        print(f"По индексу соответствий найдено {mapped} из {len(pairs)} тайтлов, остальные пойдут через поиск")
+        new_data, deferred = enrich_anime(pairs, config, catalog.next_id, cache, id_map)
+        if config.MIRROR_IMAGES:
+            mirror_images(new_data, config, cache)
+        print(f"Статистика кэша: {cache.stats()}")
+        cache.close()
+
+        for record in new_data:
+            catalog.add(record)
+
+        # JSON и снимок пишутся потоково, по одной записи
+        save_catalog(catalog, config.JSON_FILE, config.SNAPSHOT_FILE)
+        METRICS.inc("bytes_written_total", os.path.getsize(config.JSON_FILE), target="json")
+        METRICS.inc("bytes_written_total", os.path.getsize(config.SNAPSHOT_FILE), target="snapshot")
+        print(f"Данные сохранены в {config.JSON_FILE} и {config.SNAPSHOT_FILE} (всего {len(catalog)} записей)")
+        # Граница сдвигается только после сохранения, иначе упавший запуск потерял бы найденное;
+        # если часть тайтлов отложена, граница остаётся прежней, чтобы следующий обход до них дошёл
+        if frontier is not None and not deferred:
+            frontier.save()
+
+        save_to_mongodb(catalog.records, config, prune=config.MONGODB_PRUNE)
     else:
         print("Достигнут желаемый лимит аниме, новые данные не требуются")
+    catalog.close()
+    if config.METRICS_FILE:
+        METRICS.write(config.METRICS_FILE)
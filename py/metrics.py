@@ -0,0 +1,229 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = "anime_"
+
+# Счётчики, по которым в JSON-отчёте считается скорость (штук в секунду за время запуска)
+RATE_COUNTERS = ("stage_records_total",)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины, в которую он попадает)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Потокобезопасный реестр счётчиков и гистограмм с метками.
+
+    Метрики копятся в памяти процесса и выгружаются одним файлом в конце запуска:
+    в текстовом формате Prometheus (для node_exporter textfile collector) или в JSON.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Замеряет длительность блока в гистограмму `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_request(self, source, status, seconds, size=0):
+        """Учитывает один сетевой запрос к внешнему источнику."""
+        self.inc("http_requests_total", source=source, status=str(status))
+        self.observe("http_request_seconds", seconds, source=source)
+        if size:
+            self.inc("http_response_bytes_total", size, source=source)
+        if status == 429:
+            self.inc("rate_limited_total", source=source)
+
+    def snapshot(self):
+        """Текущее состояние в виде словаря (основа JSON-отчёта)."""
+        elapsed = time.time() - self.started
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": h.count, "sum": round(h.sum, 6),
+                           "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99),
+                           "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))}
+                          for (name, labels), h in sorted(self._histograms.items())]
+
+        def total(name, **labels):
+            return sum(c["value"] for c in counters
+                       if c["name"] == name and all(c["labels"].get(k) == v for k, v in labels.items()))
+
+        sources = sorted({c["labels"]["source"] for c in counters if c["name"] in ("cache_hits_total",
+                                                                                   "cache_misses_total")})
+        cache_hit_ratio = {}
+        for source in sources:
+            hits, misses = total("cache_hits_total", source=source), total("cache_misses_total", source=source)
+            cache_hit_ratio[source] = round(hits / (hits + misses), 4) if hits + misses else 0.0
+
+        rates = {}
+        for c in counters:
+            if c["name"] in RATE_COUNTERS and elapsed > 0:
+                stage = c["labels"].get("stage", c["name"])
+                rates[stage] = rates.get(stage, 0) + c["value"] / elapsed
+
+        return {"started": self.started, "elapsed_seconds": round(elapsed, 3), "counters": counters,
+                "histograms": histograms, "cache_hit_ratio": cache_hit_ratio,
+                "records_per_second": {stage: round(rate, 3) for stage, rate in rates.items()}}
+
+    def to_prometheus(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4)."""
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def render_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                declared.add(name)
+            lines.append(f"{PREFIX}{name}{render_labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{PREFIX}{name}_bucket{render_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{render_labels(labels)} {h.sum}")
+            lines.append(f"{PREFIX}{name}_count{render_labels(labels)} {h.count}")
+        lines.append(f"# TYPE {PREFIX}run_started_seconds gauge")
+        lines.append(f"{PREFIX}run_started_seconds {self.started}")
+        lines.append(f"# TYPE {PREFIX}run_duration_seconds gauge")
+        lines.append(f"{PREFIX}run_duration_seconds {time.time() - self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Атомарно сохраняет метрики: *.prom — в формате Prometheus, иначе — JSON."""
+        path = Path(path)
+        if path.suffix == ".prom":
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), ensure_ascii=False, indent=4)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(content, encoding="utf-8")
+        os.replace(tmp_path, path)
+        print(f"Метрики сохранены в {path}")
+
+
+# Общий для процесса реестр; при шардированном обходе дочерние процессы ведут свои копии
+METRICS = Metrics()
+
+
+# В Python 3.12+ активным может быть только один cProfile на процесс, поэтому профилируемые
+# вызовы всех стадий выполняются по очереди
+_PROFILE_LOCK = threading.Lock()
+
+
+class StageProfiler:
+    """cProfile для одной стадии: профилирует только вызовы обёрнутых функций, в каком бы потоке они ни шли.
+
+    Профилируемые вызовы сериализуются общей блокировкой (параллельность при профилировании теряется,
+    зато время каждой стадии не смешивается с другими). Результат сохраняется в `<directory>/<name>.prof`
+    (смотреть через `python -m pstats` или snakeviz).
+    """
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = Path(directory)
+        self._profile = cProfile.Profile()
+        self._used = False
+
+    def wrap(self, func):
+        def profiled(*args, **kwargs):
+            with _PROFILE_LOCK:
+                self._used = True
+                self._profile.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._profile.disable()
+        return profiled
+
+    def dump(self):
+        with _PROFILE_LOCK:
+            if not self._used:
+                return None
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / f"{self.name}.prof"
+            self._profile.dump_stats(path)
+        print(f"Профиль стадии {self.name} сохранён в {path}")
+        return path
+
+
+def profile_stage(name, func, directory):
+    """Оборачивает `func` профайлером стадии, если задан каталог профилей; иначе возвращает как есть."""
+    if not directory:
+        return func, None
+    profiler = StageProfiler(name, directory)
+    return profiler.wrap(func), profiler
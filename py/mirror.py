@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from cache import HttpCache, make_key
+from httpclient import UpstreamError, get_client
+from metrics import METRICS
+from ratelimit import TokenBucket
+
+SOURCE = "images"
+
+# Размеры, которые зеркалируются для каждого поля (готовые варианты TMDB, без перекодирования у нас)
+IMAGE_VARIANTS = {
+    "PosterRu": ("w185", "w342", "w500"),
+    "Backdrop": ("w300", "w780", "w1280"),
+}
+
+# Ссылка TMDB на картинку: https://image.tmdb.org/t/p/<размер>/<файл>
+TMDB_IMAGE_RE = re.compile(r"^(https?://image\.tmdb\.org/t/p/)[^/]+(/.+)$")
+
+
+def variant_urls(url, sizes):
+    """Ссылки на варианты картинки нужных размеров; чужие ссылки зеркалируются как есть (ключ "original")."""
+    match = TMDB_IMAGE_RE.match(url)
+    if not match:
+        return {"original": url}
+    return {size: f"{match.group(1)}{size}{match.group(2)}" for size in sizes}
+
+
+class ImageMirror:
+    """Локальное зеркало постеров и фонов TMDB с адресацией по содержимому.
+
+    Файл хранится под именем `<sha256>.<расширение>` (в подкаталоге по первым двум символам),
+    поэтому одинаковые картинки с разных ссылок лежат на диске один раз. Соответствие ссылка → файл
+    и валидаторы (ETag / Last-Modified) хранятся в HttpCache под источником "images": свежие
+    записи не запрашиваются вовсе, устаревшие перепроверяются условным запросом. Так прерванный
+    запуск продолжается с того места, где остановился.
+    """
+
+    def __init__(self, directory, cache=None, workers=8, rate=(20, 1), variants=IMAGE_VARIANTS):
+        self.directory = Path(directory)
+        self.cache = cache
+        self.workers = workers
+        self.variants = variants
+        self.client = get_client(SOURCE)
+        self.limiter = TokenBucket(*rate)
+        self.started = time.perf_counter()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, **values):
+        with self._lock:
+            self.stats.update(values)
+
+    def _store(self, content, url):
+        """Кладёт содержимое в хранилище; возвращает путь и признак того, что файла там ещё не было."""
+        digest = hashlib.sha256(content).hexdigest()
+        suffix = Path(urlparse(url).path).suffix or ".jpg"
+        path = self.directory / digest[:2] / f"{digest}{suffix}"
+        if path.exists():
+            return path, False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+        return path, True
+
+    def fetch(self, url):
+        """Возвращает локальный путь к картинке по ссылке `url` (скачивая при необходимости) или None."""
+        key = make_key("GET", url)
+        headers = {}
+        entry = None
+        if self.cache is not None:
+            cached = self.cache.get(SOURCE, key)
+            if cached is not None and Path(cached["path"]).exists():
+                self._count(skipped=1, saved_bytes=cached["size"])
+                return cached["path"]
+            entry = self.cache.get_entry(SOURCE, key)
+            if entry is not None and Path(entry[0]["path"]).exists():
+                _, etag, last_modified = entry
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+            else:
+                entry = None
+
+        with METRICS.timer("rate_limit_wait_seconds", source=SOURCE):
+            self.limiter.acquire()
+        try:
+            response = self.client.request("GET", url, headers=headers or None)
+        except UpstreamError as e:
+            METRICS.inc("errors_total", stage="images")
+            self._count(failed=1)
+            print(f"Ошибка при загрузке {url}: {e}")
+            return None
+
+        if response.status_code == 304 and entry is not None:
+            value, etag, last_modified = entry
+            self.cache.set(SOURCE, key, value, response.headers.get("ETag", etag),
+                           response.headers.get("Last-Modified", last_modified))
+            self._count(revalidated=1, saved_bytes=value["size"])
+            return value["path"]
+        if response.status_code != 200:
+            METRICS.inc("errors_total", stage="images")
+            self._count(failed=1)
+            print(f"Картинка {url} недоступна: HTTP {response.status_code}")
+            return None
+
+        path, created = self._store(response.content, url)
+        size = len(response.content)
+        self._count(downloaded=1, downloaded_bytes=size)
+        if created:
+            METRICS.inc("bytes_written_total", size, target="images")
+        else:
+            self._count(deduplicated=1, deduplicated_bytes=size)
+        value = {"path": path.as_posix(), "size": size}
+        if self.cache is not None:
+            self.cache.set(SOURCE, key, value, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return value["path"]
+
+    def _jobs(self, record):
+        return {(field, size): url
+                for field in self.variants if record.get(field)
+                for size, url in variant_urls(record[field], self.variants[field]).items()}
+
+    def mirror_record(self, record):
+        """Зеркалирует картинки одной записи по очереди и записывает локальные пути в поле "Images"."""
+        results = {job: self.fetch(url) for job, url in self._jobs(record).items()}
+        return self._apply(record, results)
+
+    def mirror_records(self, records):
+        """Зеркалирует картинки записей параллельно (одинаковые ссылки — один раз); возвращает изменённые."""
+        jobs = [self._jobs(record) for record in records]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            for record_jobs in jobs:
+                for url in record_jobs.values():
+                    if url not in futures:
+                        futures[url] = pool.submit(self.fetch, url)
+            changed = []
+            for record, record_jobs in zip(records, jobs):
+                results = {job: futures[url].result() for job, url in record_jobs.items()}
+                if self._apply(record, results):
+                    changed.append(record)
+        return changed
+
+    @staticmethod
+    def _apply(record, results):
+        images = {}
+        for (field, size), path in results.items():
+            if path:
+                images.setdefault(field, {})[size] = path
+        if not images or record.get("Images") == images:
+            return False
+        record["Images"] = images
+        return True
+
+    def report(self):
+        """Печатает сводку: сколько скачано, с какой скоростью и сколько трафика и места сэкономлено."""
+        elapsed = time.perf_counter() - self.started
+        stats = self.stats
+        total = stats["downloaded"] + stats["revalidated"] + stats["skipped"]
+        print(f"Картинки: {total} в зеркале, скачано {stats['downloaded']} "
+              f"({stats['downloaded_bytes'] / 1024 / 1024:.1f} МБ, "
+              f"{stats['downloaded_bytes'] / 1024 / 1024 / elapsed if elapsed else 0:.2f} МБ/с, "
+              f"{stats['downloaded'] / elapsed if elapsed else 0:.1f} файлов/с), "
+              f"уже были {stats['skipped']}, не изменились (304) {stats['revalidated']}, ошибок {stats['failed']}")
+        print(f"Сэкономлено трафика: {stats['saved_bytes'] / 1024 / 1024:.1f} МБ, "
+              f"места на диске (дубликаты): {stats['deduplicated_bytes'] / 1024 / 1024:.1f} МБ "
+              f"({stats['deduplicated']} файлов)")
+        METRICS.inc("bytes_saved_total", stats["saved_bytes"], target="images")
+        return dict(stats)
+
+
+def mirror_images(records, config, cache=None):
+    """Зеркалирует постеры и фоны записей в config.IMAGES_DIR и печатает сводку; возвращает изменённые записи."""
+    mirror = ImageMirror(config.IMAGES_DIR, cache, workers=config.WORKERS, rate=config.IMAGE_RATE)
+    changed = mirror.mirror_records(records)
+    mirror.report()
+    return changed
+
+
+if __name__ == "__main__":
+    from main import AnimeConfig, save_to_mongodb
+    from snapshot import load_snapshot_catalog, save_catalog
+
+    parser = argparse.ArgumentParser(description="Локальное зеркало постеров и фонов каталога")
+    parser.add_argument("--limit", type=int, help="Обработать не больше стольких записей")
+    args = parser.parse_args()
+
+    config = AnimeConfig()
+    catalog = load_snapshot_catalog(config.JSON_FILE, config.SNAPSHOT_FILE)
+    records = [record for _, record in zip(range(args.limit or len(catalog)), catalog)]
+    print(f"Зеркалирование картинок для {len(records)} из {len(catalog)} записей")
+
+    cache = HttpCache(config.CACHE_FILE)
+    changed = mirror_images(records, config, cache)
+    cache.close()
+
+    for record in changed:
+        catalog.replace(record)
+    if changed:
+        save_catalog(catalog, config.JSON_FILE, config.SNAPSHOT_FILE)
+        print(f"Локальные пути записаны в {len(changed)} записей ({config.JSON_FILE}, {config.SNAPSHOT_FILE})")
+    catalog.close()
+    if changed:
+        save_to_mongodb(changed, config)
+    if config.METRICS_FILE:
+        METRICS.write(config.METRICS_FILE)
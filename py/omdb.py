@@ -1,44 +1,61 @@
 import json
-import time
-import requests
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import os
 from pathlib import Path
+from sink import sync_to_mongodb
+from cache import HttpCache, cached_request
+from httpclient import UpstreamError
+from journal import Journal
+from metrics import METRICS, profile_stage
+from ratelimit import Backoff, BudgetExhausted, DailyBudget, TokenBucket
+from snapshot import load_snapshot_catalog
 
 # Загрузка переменных окружения
 load_dotenv()
 
 
 class AnimeConfig:
-    def __init__(self, delay=1, input_file="anime_ttid_list.json", output_file="anime_full_data.json"):
-        self.DELAY = delay  # Задержка между запросами к OMDB (секунды)
+    def __init__(self, delay=1, input_file="anime_ttid_list.json", output_file="anime_full_data.json", workers=4):
+        self.DELAY = delay  # Начальная задержка при ошибках OMDB (секунды), дальше растёт экспоненциально
+        self.WORKERS = workers  # Количество параллельных запросов к OMDB
+        self.RATE = (10, 1)  # Не больше 10 запросов в секунду к OMDB
+        self.RETRIES = 3  # Повторы при временных ошибках
+        self.DAILY_LIMIT = 1000  # Дневной лимит запросов бесплатного ключа OMDB
+        self.QUOTA_FILE = "omdb_quota.json"  # Расход дневного лимита между запусками
         self.MONGODB_URI = os.getenv('MONGODB_URI')
         self.DB_NAME = os.getenv('DB_NAME', 'anime_db')
         self.COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'anime_full_data')
+        self.MONGODB_PRUNE = os.getenv('MONGODB_PRUNE') == '1'  # Разовая очистка коллекции: дубликаты и документы не из набора
         self.OMDB_API_KEY = os.getenv('OMDB_API_KEY')  # Убедитесь, что ключ добавлен в .env
         self.INPUT_FILE = input_file  # Файл с TTID
         self.OUTPUT_FILE = output_file  # Файл для сохранения полной информации
+        self.JOURNAL_FILE = "anime_full_data.jsonl"  # Журнал обработанных TTID (контрольная точка)
+        self.CATALOG_FILE = "anime_list.json"  # Каталог main.py: его TTID запрашиваются первыми (None — без приоритета)
+        self.CACHE_FILE = "http_cache.sqlite"  # Общий с main.py кэш ответов API
+        self.METRICS_FILE = os.getenv('METRICS_FILE')  # *.prom — формат Prometheus, иначе JSON
+        self.PROFILE_DIR = os.getenv('PROFILE_DIR')  # Каталог для cProfile по стадиям (None — без профилирования)
 
 
-def fetch_omdb_data(ttid, api_key, delay):
-    """Получает данные по TTID из OMDB API."""
-    url = f"http://www.omdbapi.com/?i={ttid}&apikey={api_key}"
+OMDB_URL = "https://www.omdbapi.com/"
 
-    try:
-        response = requests.get(url)
-        data = response.json()
+# Ошибки OMDB, означающие, что данных по TTID нет и повторный запрос бесполезен
+OMDB_NOT_FOUND_ERRORS = {"Incorrect IMDb ID.", "Movie not found!"}
 
-        if data.get("Response") == "True":
-            print(f"Успешно получены данные для {ttid}")
-            return data
-        else:
-            print(f"Ошибка OMDB для {ttid}: {data.get('Error', 'Неизвестная ошибка')}")
-            return None
 
-    except Exception as e:
-        print(f"Ошибка запроса для {ttid}: {e}")
-        return None
+# Ошибка OMDB при исчерпании дневного лимита ключа
+OMDB_LIMIT_ERROR = "Request limit reached!"
+
+# Уникальный индекс по ttid: по нему сопоставляются записи при синхронизации
+OMDB_INDEXES = [([("ttid", 1)], {"unique": True})]
+
+
+def request_omdb(ttid, api_key, cache=None, limiter=None, budget=None):
+    """Запрашивает OMDB API по TTID и возвращает ответ как есть."""
+    # Кэшируем только найденные тайтлы, чтобы ошибки вроде исчерпания лимита не сохранялись
+    return cached_request(cache, "omdb", "GET", OMDB_URL, params={"i": ttid, "apikey": api_key},
+                          cacheable=lambda d: d.get("Response") == "True",
+                          limiter=limiter, budget=budget)
 
 
 def load_ttids(json_file):
@@ -55,64 +72,166 @@ def load_ttids(json_file):
         return []
 
 
+def prioritize(ttids, catalog_file):
+    """Упорядочивает TTID по приоритету: сначала те, что уже есть в каталоге main.py
+    (их карточки показывает сайт), затем остальные; внутри групп сохраняется порядок входного файла."""
+    if not catalog_file:
+        return ttids
+    catalog = load_snapshot_catalog(catalog_file)
+    try:
+        linked = [ttid for ttid in ttids if ttid in catalog]
+    finally:
+        catalog.close()
+    linked_set = set(linked)
+    return linked + [ttid for ttid in ttids if ttid not in linked_set]
+
+
 def save_to_json(data, output_file):
     """Сохраняет данные в JSON-файл."""
     try:
         with open(output_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
+        METRICS.inc("bytes_written_total", os.path.getsize(output_file), target="json")
         print(f"Сохранено {len(data)} записей в {output_file}")
     except Exception as e:
         print(f"Ошибка при сохранении в {output_file}: {e}")
 
 
-def save_to_mongodb(data, config):
-    """Сохраняет данные в MongoDB Atlas."""
+def save_to_mongodb(data, config, prune=False):
+    """Сохраняет данные в MongoDB Atlas (инкрементально, по ttid); `prune=True` — только для полного набора."""
+    return sync_to_mongodb(data, config, key="ttid", indexes=OMDB_INDEXES, prune=prune)
+
+
+def seed_journal(journal, output_file):
+    """Переносит в журнал данные из ранее сохранённого JSON, которых в нём ещё нет, чтобы не запрашивать их заново.
+
+    Записи журнала новее JSON, поэтому уже обработанные TTID не перезаписываются.
+    """
     try:
-        client = MongoClient(config.MONGODB_URI)
-        db = client[config.DB_NAME]
-        collection = db[config.COLLECTION_NAME]
-        collection.delete_many({})  # Очищаем коллекцию перед записью
-        collection.insert_many(data)
-        print(f"Сохранено {len(data)} записей в MongoDB")
+        if not Path(output_file).exists():
+            return
+        with open(output_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        seeded = 0
+        for item in data:
+            if item["ttid"] not in journal.done:
+                journal.append(item["ttid"], item)
+                seeded += 1
+        if seeded:
+            journal.flush()
+            print(f"В журнал перенесено {seeded} записей из {output_file}")
     except Exception as e:
-        print(f"Ошибка при сохранении в MongoDB: {e}")
-    finally:
-        client.close()
+        print(f"Ошибка при переносе {output_file} в журнал: {e}")
+
+
+def fetch_with_backoff(ttid, config, cache, limiter, budget, backoff):
+    """Запрашивает TTID с повторами при временных ошибках.
+
+    Возвращает (ttid, данные, статус), где статус — "ok", "missing" (данных нет),
+    "deferred" (исчерпан дневной бюджет) или "failed" (временная ошибка).
+    HTTP-ошибки (429, 5xx, сеть) повторяет общий клиент OMDB; если он сдался или автомат
+    разомкнут, TTID сразу считается "failed" и не попадает в журнал, то есть повторится в следующий раз.
+    """
+    for attempt in range(config.RETRIES + 1):
+        if attempt:
+            METRICS.inc("retries_total", source="omdb")
+        backoff.wait()
+        try:
+            data = request_omdb(ttid, config.OMDB_API_KEY, cache, limiter, budget)
+        except BudgetExhausted:
+            return ttid, None, "deferred"
+        except UpstreamError as e:
+            print(f"OMDB недоступен для {ttid}: {e}")
+            backoff.failure()
+            return ttid, None, "failed"
+        except Exception as e:
+            print(f"Ошибка запроса для {ttid} (попытка {attempt + 1}): {e}")
+            backoff.failure()
+            continue
+
+        if data.get("Response") == "True":
+            backoff.success()
+            return ttid, data, "ok"
+        if data.get("Error") in OMDB_NOT_FOUND_ERRORS:
+            backoff.success()
+            print(f"Ошибка OMDB для {ttid}: {data['Error']}")
+            return ttid, None, "missing"
+        if data.get("Error") == OMDB_LIMIT_ERROR:
+            METRICS.inc("rate_limited_total", source="omdb")
+            budget.exhaust()
+            return ttid, None, "deferred"
+
+        print(f"Ошибка OMDB для {ttid} (попытка {attempt + 1}): {data.get('Error', 'Неизвестная ошибка')}")
+        backoff.failure()
+
+    return ttid, None, "failed"
 
 
 def process_ttids(config):
-    """Обрабатывает TTID через OMDB и собирает полные данные."""
+    """Обрабатывает TTID через OMDB и собирает полные данные.
+
+    Запросы идут параллельно через общий пул соединений в пределах дневного бюджета;
+    TTID из каталога main.py идут первыми (см. prioritize), а не уложившиеся в бюджет
+    откладываются до следующего запуска. Результаты дописываются в журнал, поэтому
+    после перезапуска уже обработанные TTID пропускаются.
+    """
     ttids = load_ttids(config.INPUT_FILE)
     if not ttids:
         print("Нет TTID для обработки")
         return
 
-    full_data = []
-    processed_count = 0
-
-    for ttid in ttids:
-        omdb_data = fetch_omdb_data(ttid, config.OMDB_API_KEY, config.DELAY)
-        if omdb_data:
-            # Добавляем TTID в данные для удобства
-            omdb_data["ttid"] = ttid
-            full_data.append(omdb_data)
-            processed_count += 1
+    journal = Journal(config.JOURNAL_FILE)
+    seed_journal(journal, config.OUTPUT_FILE)
+    pending = prioritize([ttid for ttid in dict.fromkeys(ttids) if ttid not in journal.done], config.CATALOG_FILE)
+    print(f"Уже обработано {len(ttids) - len(pending)} TTID, осталось {len(pending)}")
 
-        # Задержка между запросами, чтобы не превысить лимит OMDB (1000 запросов в день для бесплатного ключа)
-        time.sleep(config.DELAY)
+    budget = DailyBudget(config.DAILY_LIMIT, config.QUOTA_FILE)
+    print(f"Доступно запросов к OMDB на сегодня: {budget.remaining} из {config.DAILY_LIMIT}")
 
-        # Промежуточное сохранение каждые 100 записей
-        if processed_count % 100 == 0:
-            save_to_json(full_data, config.OUTPUT_FILE)
-            print(f"Промежуточное сохранение: обработано {processed_count} из {len(ttids)}")
+    cache = HttpCache(config.CACHE_FILE)
+    limiter = TokenBucket(*config.RATE)
+    backoff = Backoff(base=config.DELAY)
+    counts = {"ok": 0, "missing": 0, "deferred": 0, "failed": 0}
+    fetch, profiler = profile_stage("omdb", fetch_with_backoff, config.PROFILE_DIR)
 
-    # Финальное сохранение
+    try:
+        with ThreadPoolExecutor(max_workers=config.WORKERS) as pool:
+            futures = [pool.submit(fetch, ttid, config, cache, limiter, budget, backoff)
+                       for ttid in pending]
+            for future in as_completed(futures):
+                ttid, omdb_data, status = future.result()
+                counts[status] += 1
+                METRICS.inc("stage_records_total", stage="omdb", status=status)
+                if status == "ok":
+                    print(f"Успешно получены данные для {ttid}")
+                    # Добавляем TTID в данные для удобства
+                    omdb_data["ttid"] = ttid
+                    journal.append(ttid, omdb_data)
+                elif status == "missing":
+                    journal.append(ttid, None)
+
+                if counts["ok"] and counts["ok"] % 100 == 0 and status == "ok":
+                    print(f"Обработано {counts['ok']} из {len(pending)}")
+    finally:
+        print(f"Итог: получено {counts['ok']}, нет данных {counts['missing']}, "
+              f"отложено до следующего дня {counts['deferred']}, ошибок {counts['failed']}")
+        print(f"Статистика кэша: {cache.stats()}")
+        cache.close()
+        journal.flush()
+        if profiler:
+            profiler.dump()
+
+    # Финальное сохранение: сворачиваем журнал в JSON и MongoDB
+    full_data = journal.compact()
+    journal.close()
     save_to_json(full_data, config.OUTPUT_FILE)
-    save_to_mongodb(full_data, config)
+    save_to_mongodb(full_data, config, prune=config.MONGODB_PRUNE)
+    if config.METRICS_FILE:
+        METRICS.write(config.METRICS_FILE)
 
 
 if __name__ == "__main__":
-    config = AnimeConfig(delay=1)  # Задержка 1 секунда для соблюдения лимитов OMDB
+    config = AnimeConfig(delay=1, workers=4)
 
     if not config.OMDB_API_KEY:
         print("Ошибка: OMDB_API_KEY не указан в .env файле")
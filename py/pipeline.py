@@ -0,0 +1,368 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import Counter
+
+from pymongo import MongoClient
+
+import omdb
+from cache import HttpCache
+from discovery import (DeltaFrontier, DiscoveryUnavailable, create_title_session, fetch_localized_title,
+                       iter_delta_pages, iter_search_pages)
+from httpclient import RetryQueue, UpstreamError, wait_for_upstreams
+from idmap import measure_load
+from journal import Journal
+from metrics import METRICS, StageProfiler, profile_stage
+from mirror import ImageMirror
+from main import (CATALOG_FACETS, CATALOG_INDEXES, AnimeConfig, build_anime_record, get_anilist_batch,
+                  get_tmdb_data_by_ttid, new_titles_needed)
+from ratelimit import Backoff, DailyBudget, TokenBucket
+from sink import sync_to_mongodb, update_facets
+from snapshot import load_snapshot_catalog, save_catalog
+
+# Маркер конца потока в очередях между стадиями
+END = object()
+
+
+class PipelineConfig(AnimeConfig):
+    """Настройки единого конвейера: каталог main.py, OMDB из omdb.py и параллелизм стадий."""
+
+    def __init__(self, limit=1500, queue_size=100):
+        super().__init__(limit=limit)
+        self.omdb = omdb.AnimeConfig()
+        self.QUEUE_SIZE = queue_size  # Ёмкость очереди между стадиями
+        self.STAGE_WORKERS = {
+            "omdb": self.omdb.WORKERS,
+            "tmdb": self.WORKERS,
+            "titles": 4,
+            "anilist": 2,
+            "images": 4,  # Только при MIRROR_IMAGES
+        }
+        self.SINK_BATCH = 25  # Записи уходят в MongoDB пакетами по столько штук
+        self.TTID_FILE = "anime_ttid_list.json"
+
+
+class Stage:
+    """Стадия конвейера: `workers` потоков берут записи из входной очереди и кладут результат в следующую.
+
+    При batch_size > 1 функция получает список записей (собирается, пока очередь не опустеет
+    или не пройдёт batch_timeout секунд) и возвращает список результатов.
+    Результат None означает, что запись дальше не идёт.
+    Если задан profile_dir, вызовы func профилируются в `<profile_dir>/<name>.prof`; готовый profiler
+    (StageProfiler) позволяет копить один профиль на несколько запусков стадии.
+    Записи, на которых func бросила UpstreamError (источник недоступен), откладываются в retry_queue.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=100, batch_size=1, batch_timeout=1.0, profile_dir=None,
+                 retry_queue=None, profiler=None):
+        self.name = name
+        self.retry_queue = retry_queue
+        if profiler is not None:
+            self.func, self.profiler = profiler.wrap(func), profiler
+        else:
+            self.func, self.profiler = profile_stage(name, func, profile_dir)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def start(self, outbox):
+        threads = [threading.Thread(target=self._work, args=(outbox,), daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        def close():
+            for thread in threads:
+                thread.join()
+            if self.profiler:
+                self.profiler.dump()
+            if outbox is not None:
+                outbox.put(END)
+
+        closer = threading.Thread(target=close, daemon=True)
+        closer.start()
+        return closer
+
+    def _take(self):
+        """Забирает из очереди одну запись или пакет; возвращает (записи, получен ли конец потока)."""
+        item = self.inbox.get()
+        if item is END:
+            return [], True
+        items = [item]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(items) < self.batch_size:
+            try:
+                item = self.inbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is END:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _work(self, outbox):
+        while True:
+            items, finished = self._take()
+            if items:
+                try:
+                    with METRICS.timer("stage_seconds", stage=self.name):
+                        results = self.func(items) if self.batch_size > 1 else [self.func(items[0])]
+                except UpstreamError as e:
+                    print(f"[{self.name}] Источник недоступен, отложено {len(items)}: {e}")
+                    if self.retry_queue is not None:
+                        for item in items:
+                            self.retry_queue.defer(item, e)
+                    results = []
+                except Exception as e:
+                    METRICS.inc("errors_total", stage=self.name)
+                    print(f"[{self.name}] Ошибка обработки: {e}")
+                    results = []
+                METRICS.inc("stage_records_total", len(items), stage=self.name)
+                with self._lock:
+                    self.processed += len(items)
+                for result in results:
+                    if result is not None and outbox is not None:
+                        outbox.put(result)
+            if finished:
+                # Возвращаем маркер, чтобы остановились и остальные потоки стадии
+                self.inbox.put(END)
+                return
+
+
+def run_pipeline(config):
+    """Запускает discover → OMDB → TMDB → русские названия → AniList → sink как потоковые стадии.
+
+    Каждая новая запись проходит все стадии сразу после обнаружения, не дожидаясь конца обхода.
+    """
+    catalog = load_snapshot_catalog(config.JSON_FILE, config.SNAPSHOT_FILE)
+    needed_count = new_titles_needed(config, len(catalog))
+    print(f"Найдено {len(catalog)} существующих аниме, требуется {needed_count} новых")
+    if needed_count <= 0:
+        print("Достигнут желаемый лимит аниме, новые данные не требуются")
+        catalog.close()
+        if config.METRICS_FILE:
+            METRICS.write(config.METRICS_FILE)
+        return
+
+    cache = HttpCache(config.CACHE_FILE)
+    id_map = measure_load(config.ID_MAP_FILE)
+
+    # OMDB: общий журнал и бюджет с omdb.py
+    omdb_config = config.omdb
+    journal = Journal(omdb_config.JOURNAL_FILE)
+    # Без переноса ранее сохранённых данных итоговый JSON перезаписался бы только новыми строками
+    omdb.seed_journal(journal, omdb_config.OUTPUT_FILE)
+    omdb_budget = DailyBudget(omdb_config.DAILY_LIMIT, omdb_config.QUOTA_FILE)
+    omdb_limiter = TokenBucket(*omdb_config.RATE)
+    omdb_backoff = Backoff(base=omdb_config.DELAY)
+
+    tmdb_limiter = TokenBucket(*config.TMDB_RATE)
+    anilist_limiter = TokenBucket(*config.ANILIST_RATE, burst=5)
+    title_session = create_title_session("ru-RU, ru")
+    title_limiter = TokenBucket(5, 1)
+
+    def omdb_stage(record):
+        if omdb_config.OMDB_API_KEY and record["ttid"] not in journal.done:
+            ttid, data, status = omdb.fetch_with_backoff(record["ttid"], omdb_config, cache, omdb_limiter,
+                                                         omdb_budget, omdb_backoff)
+            if status == "ok":
+                data["ttid"] = ttid
+                journal.append(ttid, data)
+                # OMDB дополняет то, чего не оказалось в результатах поиска IMDb
+                if not record["year"] and data.get("Year"):
+                    record["year"] = data["Year"][:4]
+                if record["rating"] == "N/A" and data.get("imdbRating", "N/A") != "N/A":
+                    record["rating"] = data["imdbRating"]
+            elif status == "missing":
+                journal.append(ttid, None)
+        return record
+
+    def tmdb_stage(record):
+        record["tmdb"] = get_tmdb_data_by_ttid(record["ttid"], record["title"], config, tmdb_limiter, cache, id_map)
+        return record
+
+    def titles_stage(record):
+        record["title_ru"] = fetch_localized_title(record["ttid"], "ru-RU, ru", title_session, title_limiter,
+                                                   cache) or record["title"]
+        return record
+
+    def anilist_stage(records):
+        anilist_ids = [(id_map.get(record["ttid"]) or {}).get("anilist_id") for record in records]
+        results = get_anilist_batch([record["title"] for record in records], limiter=anilist_limiter, cache=cache,
+                                    anilist_ids=anilist_ids)
+        for record, anilist_data in zip(records, results):
+            record["anilist"] = anilist_data
+        return records
+
+    image_mirror = None
+    if config.MIRROR_IMAGES:
+        image_mirror = ImageMirror(config.IMAGES_DIR, cache, workers=config.STAGE_WORKERS["images"],
+                                   rate=config.IMAGE_RATE)
+
+    def images_stage(record):
+        images = {"PosterRu": record["tmdb"]["poster_path"], "Backdrop": record["tmdb"]["backdrop_path"]}
+        if image_mirror.mirror_record(images):
+            record["images"] = images["Images"]
+        return record
+
+    mongo_client = MongoClient(config.MONGODB_URI)
+    sink_buffer = []
+    sink_changes = []
+
+    def flush_sink():
+        if sink_buffer:
+            counts = sync_to_mongodb(sink_buffer, config, key="TTID", client=mongo_client, indexes=CATALOG_INDEXES)
+            sink_changes.append(counts["inserted"] + counts["updated"])
+            sink_buffer.clear()
+
+    def sink_stage(record):
+        anime = build_anime_record(catalog.next_id, record, {"title": record["title_ru"]}, record["tmdb"],
+                                   record["anilist"])
+        if record.get("images"):
+            anime["Images"] = record["images"]
+        catalog.add(anime)
+        sink_buffer.append(anime)
+        print(f"Добавлено: {anime['TitleEng']} (ID {anime['ID']}, TTID {anime['TTID']})")
+        if len(sink_buffer) >= config.SINK_BATCH:
+            flush_sink()
+
+    retry_queue = RetryQueue()
+    # Профили и счётчики стадий общие для первого прохода и повторов
+    profilers = {}
+    processed = Counter()
+
+    def make_stage(name, func, workers, **kwargs):
+        if config.PROFILE_DIR and name not in profilers:
+            profilers[name] = StageProfiler(name, config.PROFILE_DIR)
+        return Stage(name, func, workers, config.QUEUE_SIZE, profiler=profilers.get(name), **kwargs)
+
+    def start_stages():
+        stages = [
+            make_stage("omdb", omdb_stage, config.STAGE_WORKERS["omdb"]),
+            make_stage("tmdb", tmdb_stage, config.STAGE_WORKERS["tmdb"], retry_queue=retry_queue),
+            make_stage("titles", titles_stage, config.STAGE_WORKERS["titles"]),
+            make_stage("anilist", anilist_stage, config.STAGE_WORKERS["anilist"],
+                       batch_size=config.ANILIST_BATCH_SIZE, retry_queue=retry_queue),
+            # Один поток: ID присваиваются последовательно, а каталог меняется без гонок
+            make_stage("sink", sink_stage, 1),
+        ]
+        if image_mirror:
+            # Картинки скачиваются до sink, чтобы локальные пути попали в запись сразу
+            stages.insert(-1, make_stage("images", images_stage, config.STAGE_WORKERS["images"]))
+        closers = [stage.start(following.inbox if following else None)
+                   for stage, following in zip(stages, stages[1:] + [None])]
+        return stages, closers
+
+    def finish_stages(stages, closers):
+        for closer in closers:
+            closer.join()
+        processed.update({stage.name: stage.processed for stage in stages})
+
+    stages, closers = start_stages()
+
+    frontier = None
+    if config.DISCOVERY_BACKEND == "delta":
+        frontier = DeltaFrontier(config.FRONTIER_FILE, "en-US, en")
+        pages = iter_delta_pages("en-US, en", catalog, frontier, page_size=config.DELTA_PAGE_SIZE)
+    else:
+        pages = iter_search_pages("en-US, en")
+
+    started = time.perf_counter()
+    discovered = []
+    try:
+        for items in pages:
+            for item in items:
+                if item["ttid"] in catalog or not item["title"]:
+                    continue
+                discovered.append(item["ttid"])
+                METRICS.inc("stage_records_total", stage="discover")
+                stages[0].inbox.put(item)
+                if len(discovered) >= needed_count:
+                    break
+            if len(discovered) >= needed_count:
+                break
+    except DiscoveryUnavailable as e:
+        print(f"Страница поиска IMDb недоступна ({e}); для обхода через браузер используйте main.py")
+    finally:
+        # Закрываем обход явно: для "delta" это фиксирует, дошёл ли он до границы
+        pages.close()
+        stages[0].inbox.put(END)
+        finish_stages(stages, closers)
+
+    # Тайтлы, отложенные из-за недоступности TMDB/AniList, проходят стадии заново после восстановления
+    for attempt in range(config.RETRY_ROUNDS):
+        if not retry_queue:
+            break
+        wait_for_upstreams(("tmdb", "anilist"))
+        deferred = retry_queue.drain()
+        print(f"Повтор {attempt + 1}: {len(deferred)} отложенных тайтлов")
+        retry_stages, retry_closers = start_stages()
+        for record in deferred:
+            retry_stages[0].inbox.put(record)
+        retry_stages[0].inbox.put(END)
+        finish_stages(retry_stages, retry_closers)
+    if retry_queue:
+        print(f"Не удалось обработать {len(retry_queue)} тайтлов: источники недоступны, повторим при следующем запуске")
+
+    flush_sink()
+    # Сводки пересчитываются один раз в конце, а не после каждого пакета
+    if any(sink_changes):
+        update_facets(config, CATALOG_FACETS, client=mongo_client)
+    mongo_client.close()
+    elapsed = time.perf_counter() - started
+    print(f"Обнаружено {len(discovered)} новых тайтлов, обработано за {elapsed:.1f} с "
+          f"({', '.join(f'{name}: {count}' for name, count in processed.items())})")
+    if image_mirror:
+        image_mirror.report()
+    print(f"Статистика кэша: {cache.stats()}")
+    cache.close()
+
+    save_catalog(catalog, config.JSON_FILE, config.SNAPSHOT_FILE)
+    print(f"Данные сохранены в {config.JSON_FILE} и {config.SNAPSHOT_FILE} (всего {len(catalog)} записей)")
+    catalog.close()
+    # С отложенными тайтлами граница остаётся прежней, чтобы следующий обход до них дошёл
+    if frontier is not None and not retry_queue:
+        frontier.save()
+
+    # Список TTID для test.py/omdb.py: новые TTID в начале, как в test.py
+    known_ttids = omdb.load_ttids(config.TTID_FILE)
+    ttids = list(dict.fromkeys(discovered + known_ttids))
+    with open(config.TTID_FILE, "w", encoding="utf-8") as f:
+        json.dump([{"ttid": ttid} for ttid in ttids], f, ensure_ascii=False, indent=4)
+
+    full_data = journal.compact()
+    journal.close()
+    omdb.save_to_json(full_data, omdb_config.OUTPUT_FILE)
+    omdb.save_to_mongodb(full_data, omdb_config)
+    if config.METRICS_FILE:
+        METRICS.write(config.METRICS_FILE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Потоковый конвейер: IMDb → OMDB → TMDB → AniList → MongoDB")
+    parser.add_argument("--limit", type=int, default=1500, help="Желаемый размер каталога")
+    parser.add_argument("--queue-size", type=int, default=100, help="Ёмкость очередей между стадиями")
+    for stage_name in ("omdb", "tmdb", "titles", "anilist", "images"):
+        parser.add_argument(f"--{stage_name}-workers", type=int, help=f"Потоков на стадии {stage_name}")
+    parser.add_argument("--images", action="store_true", help="Скачивать постеры и фоны в локальное зеркало")
+    parser.add_argument("--delta", action="store_true", help="Искать только новое, до границы прошлого обхода")
+    parser.add_argument("--metrics", help="Файл метрик: *.prom — формат Prometheus, иначе JSON")
+    parser.add_argument("--profile", metavar="DIR", help="Сохранить cProfile каждой стадии в каталог DIR")
+    args = parser.parse_args()
+
+    pipeline_config = PipelineConfig(limit=args.limit, queue_size=args.queue_size)
+    if args.images:
+        pipeline_config.MIRROR_IMAGES = True
+    if args.delta:
+        pipeline_config.DISCOVERY_BACKEND = "delta"
+    pipeline_config.METRICS_FILE = args.metrics or pipeline_config.METRICS_FILE
+    pipeline_config.PROFILE_DIR = args.profile or pipeline_config.PROFILE_DIR
+    for stage_name in pipeline_config.STAGE_WORKERS:
+        workers = getattr(args, f"{stage_name}_workers")
+        if workers:
+            pipeline_config.STAGE_WORKERS[stage_name] = workers
+    run_pipeline(pipeline_config)
@@ -0,0 +1,115 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+class TokenBucket:
+    """Потокобезопасный ограничитель запросов (token bucket): не больше `calls` запросов за `period` секунд."""
+
+    def __init__(self, calls, period=1.0, burst=None):
+        self.rate = calls / period  # Скорость пополнения, токенов в секунду
+        self.capacity = burst if burst is not None else max(1, calls)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Блокирует поток, пока в корзине не наберётся нужное количество токенов."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class BudgetExhausted(Exception):
+    """Дневной лимит запросов исчерпан."""
+
+
+class DailyBudget:
+    """Дневной бюджет запросов к API с сохранением расхода в файл (сбрасывается в полночь UTC)."""
+
+    def __init__(self, limit, state_file=None):
+        self.limit = limit
+        self.state_file = Path(state_file) if state_file else None
+        self._lock = threading.Lock()
+        self._day = self._today()
+        self.used = 0
+        if self.state_file and self.state_file.exists():
+            try:
+                state = json.loads(self.state_file.read_text(encoding="utf-8"))
+                if state.get("date") == self._day:
+                    self.used = state.get("used", 0)
+            except ValueError:
+                print(f"Ошибка при чтении {self.state_file}, бюджет начинается с нуля")
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def _save(self):
+        if self.state_file:
+            self.state_file.write_text(json.dumps({"date": self._day, "used": self.used}), encoding="utf-8")
+
+    def _roll_over(self):
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self.used = 0
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self._roll_over()
+            return max(0, self.limit - self.used)
+
+    def consume(self):
+        """Списывает один запрос; бросает BudgetExhausted, если бюджет на сегодня исчерпан."""
+        with self._lock:
+            self._roll_over()
+            if self.used >= self.limit:
+                raise BudgetExhausted(f"Дневной лимит {self.limit} запросов исчерпан")
+            self.used += 1
+            self._save()
+
+    def exhaust(self):
+        """Помечает бюджет на сегодня исчерпанным (например, если API само сообщило о лимите)."""
+        with self._lock:
+            self._roll_over()
+            self.used = self.limit
+            self._save()
+
+
+class Backoff:
+    """Общая для потоков адаптивная задержка: растёт экспоненциально при ошибках и спадает при успехах."""
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def failure(self):
+        with self._lock:
+            self.delay = min(self.maximum, self.delay * 2 if self.delay else self.base)
+
+    def success(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base else 0.0
+
+    def wait(self):
+        """Ждёт текущую задержку со случайным разбросом (jitter)."""
+        delay = self.delay
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
@@ -0,0 +1,169 @@
+import argparse
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cache import HttpCache
+from httpclient import UpstreamError
+from idmap import measure_load
+from main import (TMDB_EMPTY, AnimeConfig, anilist_fields, enriched_at, get_anilist_batch, get_tmdb_data_by_ttid,
+                  save_to_mongodb, tmdb_fields)
+from metrics import METRICS
+from ratelimit import TokenBucket
+from snapshot import load_snapshot_catalog, save_catalog
+
+DAY = 24 * 60 * 60
+
+ENRICHED_AT = "EnrichedAt"
+
+# Как часто перепроверять запись в зависимости от её статуса (секунды)
+REFRESH_INTERVALS = {
+    "Выходит": 1 * DAY,
+    "В производстве": 7 * DAY,
+    "Постпродакшн": 7 * DAY,
+    "Пилот": 7 * DAY,
+    "Запланировано": 14 * DAY,
+    "Слухи": 30 * DAY,
+    "Неизвестно": 30 * DAY,
+    "Завершён": 90 * DAY,
+    "Вышел": 90 * DAY,
+    "Отменён": 180 * DAY,
+}
+DEFAULT_INTERVAL = 30 * DAY
+
+# Поля, которые обновляются при перепроверке
+REFRESH_FIELDS = ("TMDbRating", "Status", "PosterRu", "Backdrop", "OverviewRu", "Episodes", "Tags", "Genres")
+
+
+def enriched_timestamp(record):
+    """Время последнего обогащения записи (Unix time) или None, если отметки нет."""
+    try:
+        return datetime.fromisoformat(record[ENRICHED_AT]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def refresh_priority(record, now, intervals=REFRESH_INTERVALS):
+    """Ключ сортировки: сначала самые просроченные относительно своего интервала, при равенстве — с коротким.
+
+    Записи без отметки EnrichedAt (собранные до её появления) считаются просроченными бесконечно,
+    поэтому среди них первыми идут выходящие тайтлы.
+    """
+    interval = intervals.get(record.get("Status"), DEFAULT_INTERVAL)
+    stamp = enriched_timestamp(record)
+    overdue = float("inf") if stamp is None else (now - stamp) / interval
+    return -overdue, interval
+
+
+def select_due(records, budget, now=None, intervals=REFRESH_INTERVALS):
+    """Выбирает не больше `budget` записей, у которых истёк интервал перепроверки, в порядке приоритета."""
+    now = now if now is not None else time.time()
+    due = (record for record in records if -refresh_priority(record, now, intervals)[0] >= 1)
+    return heapq.nsmallest(budget, due, key=lambda record: refresh_priority(record, now, intervals))
+
+
+def apply_refresh(record, tmdb_data, anilist_data):
+    """Обновляет поля записи свежими данными и возвращает True, если что-то изменилось.
+
+    Пустые ответы (ошибка или временная недоступность API) не затирают уже собранные данные.
+    Если не ответил ни один источник, отметка EnrichedAt не сдвигается и запись останется в очереди.
+    """
+    before = {field: record.get(field) for field in REFRESH_FIELDS}
+    answered = False
+    if tmdb_data != TMDB_EMPTY:
+        record.update(tmdb_fields(tmdb_data))
+        answered = True
+    fresh = anilist_fields(anilist_data)
+    if fresh["Episodes"] is not None:
+        record["Episodes"] = fresh["Episodes"]
+        answered = True
+    for field in ("Tags", "Genres"):
+        if fresh[field]:
+            record[field] = fresh[field]
+            answered = True
+    if answered:
+        record[ENRICHED_AT] = enriched_at()
+    return any(record.get(field) != value for field, value in before.items())
+
+
+def refresh_records(records, config, cache=None, id_map=None):
+    """Перезапрашивает TMDB (условными запросами) и AniList для записей; возвращает изменившиеся.
+
+    Записи, для которых источник был недоступен, не трогаются и остаются в очереди на перепроверку.
+    """
+    tmdb_limiter = TokenBucket(*config.TMDB_RATE)
+    anilist_limiter = TokenBucket(*config.ANILIST_RATE, burst=5)
+    batch_size = config.ANILIST_BATCH_SIZE
+
+    with ThreadPoolExecutor(max_workers=config.WORKERS) as tmdb_pool, \
+            ThreadPoolExecutor(max_workers=config.WORKERS) as anilist_pool:
+        tmdb_futures = [tmdb_pool.submit(get_tmdb_data_by_ttid, record["TTID"], record["TitleEng"], config,
+                                         tmdb_limiter, cache, id_map, True)
+                        for record in records]
+        anilist_ids = [(id_map.get(record["TTID"]) or {}).get("anilist_id") if id_map is not None else None
+                       for record in records]
+        anilist_futures = [anilist_pool.submit(get_anilist_batch,
+                                               [record["TitleEng"] for record in records[i:i + batch_size]],
+                                               limiter=anilist_limiter, cache=cache,
+                                               anilist_ids=anilist_ids[i:i + batch_size], refresh=True)
+                           for i in range(0, len(records), batch_size)]
+
+        changed = []
+        for index, (record, tmdb_future) in enumerate(zip(records, tmdb_futures)):
+            try:
+                anilist_data = anilist_futures[index // batch_size].result()[index % batch_size]
+                tmdb_data = tmdb_future.result()
+            except UpstreamError as e:
+                print(f"Пропущено {record['TitleEng']} ({record['TTID']}): {e}")
+                continue
+            status = record.get("Status")
+            if apply_refresh(record, tmdb_data, anilist_data):
+                changed.append(record)
+                print(f"Обновлено: {record['TitleEng']} ({record['TTID']}): {status} → {record['Status']}")
+            METRICS.inc("stage_records_total", stage="refresh")
+
+    return changed
+
+
+def refresh_catalog(config, budget=None, dry_run=False):
+    """Перепроверяет самые устаревшие записи каталога в пределах бюджета и сохраняет изменения."""
+    budget = config.REFRESH_BUDGET if budget is None else budget
+    catalog = load_snapshot_catalog(config.JSON_FILE, config.SNAPSHOT_FILE)
+    # Записи декодируются по одной; в памяти остаются только выбранные для перепроверки
+    due = select_due(catalog, budget)
+    airing = sum(1 for record in due if record.get("Status") == "Выходит")
+    print(f"В каталоге {len(catalog)} записей, к перепроверке выбрано {len(due)} (из них выходящих {airing})")
+    if dry_run or not due:
+        for record in due:
+            print(f"{record['TTID']}: {record.get('Status')}, обогащено {record.get(ENRICHED_AT, 'неизвестно когда')}")
+        catalog.close()
+        return []
+
+    cache = HttpCache(config.CACHE_FILE)
+    id_map = measure_load(config.ID_MAP_FILE)
+    changed = refresh_records(due, config, cache, id_map)
+    print(f"Перепроверено {len(due)} записей, изменилось {len(changed)}")
+    print(f"Статистика кэша: {cache.stats()}")
+    cache.close()
+
+    # Отметка EnrichedAt обновилась и у записей без изменений, поэтому сохраняем все перепроверенные
+    for record in due:
+        catalog.replace(record)
+    save_catalog(catalog, config.JSON_FILE, config.SNAPSHOT_FILE)
+    catalog.close()
+    print(f"Данные сохранены в {config.JSON_FILE} и {config.SNAPSHOT_FILE}")
+    save_to_mongodb(due, config)
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перепроверка устаревших записей каталога (выходящие — первыми)")
+    parser.add_argument("--budget", type=int, help="Сколько записей перепроверить за запуск")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, какие записи будут обновлены")
+    args = parser.parse_args()
+
+    config = AnimeConfig()
+    refresh_catalog(config, args.budget, args.dry_run)
+    if config.METRICS_FILE:
+        METRICS.write(config.METRICS_FILE)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+from bson import encode
+from pymongo import IndexModel, MongoClient, ReplaceOne, UpdateOne
+
+from metrics import METRICS
+
+HASH_FIELD = "_hash"
+
+# Коллекции, индексы которых уже проверены в этом процессе
+_indexed = set()
+_indexed_lock = threading.Lock()
+
+
+def content_hash(record):
+    """Хэш содержимого записи (без служебных полей), не зависящий от порядка ключей."""
+    payload = {k: v for k, v in record.items() if k not in ("_id", HASH_FIELD)}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def duplicate_ids(collection, key):
+    """_id лишних документов с одинаковым `key` (для каждого ключа остаётся самый ранний)."""
+    extra = []
+    pipeline = [
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": f"${key}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        extra.extend(group["ids"][1:])
+    return extra
+
+
+def remove_duplicates(collection, key):
+    """Удаляет лишние документы с одинаковым `key`, оставляя самый ранний; возвращает число удалённых.
+
+    Нужна для коллекций, заполненных старым insert_many: там один тайтл мог лежать несколько раз.
+    """
+    extra = duplicate_ids(collection, key)
+    removed = 0
+    for i in range(0, len(extra), 1000):
+        removed += collection.delete_many({"_id": {"$in": extra[i:i + 1000]}}).deleted_count
+    return removed
+
+
+def ensure_indexes(collection, indexes):
+    """Создаёт недостающие индексы коллекции (один раз за процесс).
+
+    `indexes` — список пар (ключи, параметры) в формате IndexModel. Уже существующие индексы
+    не пересоздаются. Уникальный индекс по полю с дубликатами (наследие старого insert_many)
+    не создаётся: об этом сообщается как о необходимой миграции — один запуск с MONGODB_PRUNE=1,
+    который удаляет дубликаты до создания индексов. Ошибки создания не прерывают сохранение данных.
+    """
+    name = (collection.database.name, collection.name)
+    with _indexed_lock:
+        if name in _indexed:
+            return
+        _indexed.add(name)
+        try:
+            existing = collection.index_information()
+            missing = []
+            for keys, options in indexes:
+                model = IndexModel(keys, **options)
+                if model.document["name"] in existing:
+                    continue
+                if options.get("unique") and len(keys) == 1:
+                    duplicates = len(duplicate_ids(collection, keys[0][0]))
+                    if duplicates:
+                        METRICS.inc("errors_total", stage="mongodb_indexes")
+                        print(f"Требуется миграция {collection.name}: {duplicates} дубликатов по {keys[0][0]}, "
+                              f"уникальный индекс не создан. Запустите один раз с MONGODB_PRUNE=1")
+                        continue
+                missing.append(model)
+            if missing:
+                created = collection.create_indexes(missing)
+                print(f"Индексы {collection.name}: {', '.join(created)}")
+        except Exception as e:
+            METRICS.inc("errors_total", stage="mongodb_indexes")
+            print(f"Ошибка при создании индексов {collection.name}: {e}")
+
+
+def sync_to_mongodb(data, config, key="TTID", batch_size=1000, client=None, indexes=None, prune=False):
+    """Инкрементально сохраняет данные в MongoDB Atlas.
+
+    Записи сопоставляются по полю `key` и пишутся неупорядоченным bulk_write с upsert.
+    Записи, хэш содержимого которых не изменился, пропускаются.
+    Переданный `client` переиспользуется и не закрывается.
+    Если заданы `indexes`, перед записью проверяется их наличие (см. ensure_indexes);
+    при `prune` это происходит уже после удаления дубликатов.
+    `prune=True` — разовая очистка: `data` считается полным набором, поэтому перед записью
+    удаляются дубликаты по `key`, а после неё — документы, ключей которых нет в `data`.
+    Возвращает счётчики inserted/updated/unchanged/removed.
+    """
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "removed": 0}
+    own_client = client is None
+    started = time.perf_counter()
+    try:
+        if own_client:
+            client = MongoClient(config.MONGODB_URI)
+        collection = client[config.DB_NAME][config.COLLECTION_NAME]
+        if prune:
+            counts["removed"] += remove_duplicates(collection, key)
+        if indexes:
+            ensure_indexes(collection, indexes)
+
+        # Хэши запрашиваются только для сохраняемых ключей, поэтому небольшие пакеты дёшевы
+        keys = [record[key] for record in data]
+        stored = {}
+        for i in range(0, len(keys), batch_size):
+            for doc in collection.find({key: {"$in": keys[i:i + batch_size]}}, {key: 1, HASH_FIELD: 1, "_id": 0}):
+                stored[doc[key]] = doc.get(HASH_FIELD)
+
+        operations = []
+        sizes = []  # Размер BSON каждого документа — для учёта записанных байт
+        for record in data:
+            record_hash = content_hash(record)
+            if stored.get(record[key]) == record_hash:
+                counts["unchanged"] += 1
+                continue
+            document = {k: v for k, v in record.items() if k != "_id"}
+            document[HASH_FIELD] = record_hash
+            operations.append(UpdateOne({key: record[key]}, {"$set": document}, upsert=True))
+            sizes.append(len(encode(document)))
+
+        for i in range(0, len(operations), batch_size):
+            result = collection.bulk_write(operations[i:i + batch_size], ordered=False)
+            counts["inserted"] += result.upserted_count
+            counts["updated"] += result.modified_count
+            METRICS.inc("bytes_written_total", sum(sizes[i:i + batch_size]), target="mongodb")
+
+        # Пустой набор скорее означает сбой выше по конвейеру, чем пустой каталог: коллекцию не трогаем
+        if prune and keys:
+            counts["removed"] += collection.delete_many({key: {"$nin": keys}}).deleted_count
+
+        for name, count in counts.items():
+            METRICS.inc("mongodb_records_total", count, collection=config.COLLECTION_NAME, result=name)
+        print(f"MongoDB: добавлено {counts['inserted']}, обновлено {counts['updated']}, "
+              f"без изменений {counts['unchanged']}" + (f", удалено {counts['removed']}" if prune else ""))
+    except Exception as e:
+        METRICS.inc("errors_total", stage="mongodb")
+        print(f"Ошибка при сохранении в MongoDB: {e}")
+    finally:
+        METRICS.observe("mongodb_sync_seconds", time.perf_counter() - started, collection=config.COLLECTION_NAME)
+        if own_client and client:
+            client.close()
+    return counts
+
+
+def update_facets(config, facets, client=None):
+    """Пересчитывает сводную коллекцию `<коллекция>_facets` одним проходом агрегации ($facet).
+
+    `facets` — словарь {имя: стадии агрегации}; результат каждой грани сохраняется отдельным
+    документом {_id: имя, values: [...], updatedAt}, поэтому клиент читает грань одним findOne.
+    """
+    own_client = client is None
+    started = time.perf_counter()
+    try:
+        if own_client:
+            client = MongoClient(config.MONGODB_URI)
+        database = client[config.DB_NAME]
+        result = next(database[config.COLLECTION_NAME].aggregate([{"$facet": facets}], allowDiskUse=True), {})
+        updated_at = datetime.now(timezone.utc)
+        operations = [ReplaceOne({"_id": name}, {"values": result.get(name, []), "updatedAt": updated_at},
+                                 upsert=True)
+                      for name in facets]
+        database[f"{config.COLLECTION_NAME}_facets"].bulk_write(operations, ordered=False)
+        print(f"Сводки {config.COLLECTION_NAME}_facets обновлены: {', '.join(facets)}")
+    except Exception as e:
+        METRICS.inc("errors_total", stage="mongodb_facets")
+        print(f"Ошибка при обновлении сводок MongoDB: {e}")
+    finally:
+        METRICS.observe("mongodb_sync_seconds", time.perf_counter() - started,
+                        collection=f"{config.COLLECTION_NAME}_facets")
+        if own_client and client:
+            client.close()
@@ -0,0 +1,349 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+from catalog import TITLE_FIELDS, normalize_title
+
+# Формат снимка каталога (все числа little-endian):
+#   заголовок: сигнатура, число записей, максимальный ID
+#   столбец TTID: uint32 номер TTID ("tt0123456" → 123456) каждой записи в порядке каталога
+#   сортировка: uint32 индексы записей по возрастанию TTID (для двоичного поиска)
+#   смещения: uint64 начало каждой записи в области данных и конец последней
+#   данные: записи в компактном JSON (UTF-8) подряд
+MAGIC = b"ANICAT01"
+HEADER = struct.Struct("<8sII")
+SNAPSHOT_SUFFIX = ".bin"
+
+# Кодировщик JSON-экспорта (как json.dump(..., indent=4, ensure_ascii=False)); создаётся один раз
+EXPORT_ENCODER = json.JSONEncoder(ensure_ascii=False, indent=4)
+
+
+def ttid_number(ttid):
+    """Числовая часть TTID или 0, если TTID не в формате "tt<цифры>"."""
+    if ttid and ttid.startswith("tt") and ttid[2:].isdigit():
+        return int(ttid[2:])
+    return 0
+
+
+def _column(buffer, typecode):
+    """Столбец чисел поверх буфера: без копирования на little-endian, с копированием иначе."""
+    if sys.byteorder == "little":
+        return memoryview(buffer).cast(typecode)
+    column = array(typecode, bytes(buffer))
+    column.byteswap()
+    return column
+
+
+def _layout(count):
+    """Смещения столбцов и области данных для снимка из `count` записей."""
+    keys = HEADER.size
+    order = keys + 4 * count
+    offsets = order + 4 * count
+    offsets += -offsets % 8  # uint64 выравниваются по 8 байт
+    data = offsets + 8 * (count + 1)
+    return keys, order, offsets, data
+
+
+def encode_record(record):
+    """Запись в компактном JSON, как она хранится в снимке."""
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_snapshot(records, path, key="TTID"):
+    """Записывает снимок каталога атомарно; `records` — последовательность с len() (список, каталог)."""
+    _write_snapshot(((record, None) for record in records), len(records), path, key)
+
+
+def _write_snapshot(entries, count, path, key):
+    """Пишет снимок из пар (запись, уже закодированная запись или None)."""
+    path = Path(path)
+    keys_at, order_at, offsets_at, data_at = _layout(count)
+    keys = array("I")
+    offsets = array("Q", [0])
+    max_id = 0
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        # Сначала данные (их размер заранее неизвестен), затем столбцы перед ними
+        f.seek(data_at)
+        for record, payload in entries:
+            payload = payload if payload is not None else encode_record(record)
+            f.write(payload)
+            offsets.append(offsets[-1] + len(payload))
+            keys.append(ttid_number(record.get(key)))
+            if isinstance(record.get("ID"), int):
+                max_id = max(max_id, record["ID"])
+        if len(keys) != count:
+            raise ValueError(f"Ожидалось {count} записей, получено {len(keys)}")
+
+        order = array("I", sorted(range(count), key=keys.__getitem__))
+        if sys.byteorder != "little":
+            for column in (keys, order, offsets):
+                column.byteswap()
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, count, max_id))
+        f.seek(keys_at)
+        f.write(keys.tobytes())
+        f.seek(order_at)
+        f.write(order.tobytes())
+        f.seek(offsets_at)
+        f.write(offsets.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CatalogSnapshot:
+    """Снимок каталога, отображённый в память: TTID проверяются двоичным поиском по столбцу,
+    а записи декодируются из JSON только при обращении к ним."""
+
+    def __init__(self, path, key="TTID"):
+        self.path = Path(path)
+        self.key = key
+        self._mmap = None
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= HEADER.size:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap is None or self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{self.path} не является снимком каталога")
+        _, self.count, self.max_id = HEADER.unpack_from(self._mmap)
+        keys_at, order_at, offsets_at, self._data_at = _layout(self.count)
+        self._keys = _column(memoryview(self._mmap)[keys_at:order_at], "I")
+        self._order = _column(memoryview(self._mmap)[order_at:order_at + 4 * self.count], "I")
+        self._offsets = _column(memoryview(self._mmap)[offsets_at:self._data_at], "Q")
+
+    def _find(self, ttid):
+        number = ttid_number(ttid)
+        if not number:
+            return None
+        position = bisect.bisect_left(self._order, number, key=self._keys.__getitem__)
+        if position < self.count and self._keys[self._order[position]] == number:
+            return self._order[position]
+        return None
+
+    def __contains__(self, ttid):
+        return self._find(ttid) is not None
+
+    def __len__(self):
+        return self.count
+
+    def raw(self, index):
+        """Закодированная запись по её номеру в каталоге (байты компактного JSON)."""
+        start = self._data_at + self._offsets[index]
+        end = self._data_at + self._offsets[index + 1]
+        return self._mmap[start:end]
+
+    def record(self, index):
+        """Декодирует одну запись по её номеру в каталоге."""
+        return json.loads(self.raw(index).decode("utf-8"))
+
+    def get(self, ttid):
+        """Возвращает запись по TTID или None."""
+        index = self._find(ttid)
+        return self.record(index) if index is not None else None
+
+    def ttids(self):
+        """TTID всех записей в порядке каталога (без декодирования самих записей)."""
+        for number in self._keys:
+            yield f"tt{number:07d}"
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.record(index)
+
+    def close(self):
+        # Столбцы ссылаются на отображение, поэтому освобождаются первыми
+        for name in ("_keys", "_order", "_offsets"):
+            column = self.__dict__.pop(name, None)
+            if isinstance(column, memoryview):
+                column.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class SnapshotCatalog:
+    """Каталог поверх снимка: тот же интерфейс, что у CatalogIndex (in, len, get, find_by_title, add,
+    next_id, records), но существующие записи не загружаются в память целиком.
+
+    Индекс названий строится одним проходом по снимку при первом поиске по названию
+    и дальше обновляется на месте, поэтому запуски без такого поиска его не оплачивают.
+    """
+
+    def __init__(self, snapshot=None, key="TTID"):
+        self.snapshot = snapshot
+        self.key = key
+        self.added = []
+        self._added_by_ttid = {}
+        self._replaced = {}  # Изменённые записи снимка по TTID
+        self._by_title = None  # Название → TTID (строится при первом find_by_title)
+        self._max_id = snapshot.max_id if snapshot is not None else 0
+
+    def _index_titles(self, record):
+        for field in TITLE_FIELDS:
+            title = normalize_title(record.get(field))
+            if title:
+                self._by_title.setdefault(title, record[self.key])
+
+    def add(self, record):
+        """Добавляет новую запись (в снимок она попадёт при сохранении)."""
+        self.added.append(record)
+        self._added_by_ttid[record[self.key]] = record
+        if self._by_title is not None:
+            self._index_titles(record)
+        if isinstance(record.get("ID"), int):
+            self._max_id = max(self._max_id, record["ID"])
+
+    def replace(self, record):
+        """Подменяет существующую запись изменённой версией (в снимок она попадёт при сохранении)."""
+        if record[self.key] in self._added_by_ttid:
+            self._added_by_ttid[record[self.key]].update(record)
+        else:
+            self._replaced[record[self.key]] = record
+        if self._by_title is not None:
+            self._index_titles(record)
+
+    def __contains__(self, ttid):
+        return ttid in self._added_by_ttid or (self.snapshot is not None and ttid in self.snapshot)
+
+    def __len__(self):
+        return (len(self.snapshot) if self.snapshot is not None else 0) + len(self.added)
+
+    def get(self, ttid):
+        """Возвращает запись по TTID или None."""
+        if ttid in self._added_by_ttid:
+            return self._added_by_ttid[ttid]
+        if ttid in self._replaced:
+            return self._replaced[ttid]
+        return self.snapshot.get(ttid) if self.snapshot is not None else None
+
+    def find_by_title(self, title):
+        """Возвращает запись по английскому или русскому названию (без учёта регистра) или None."""
+        if self._by_title is None:
+            self._by_title = {}
+            for record in self:
+                self._index_titles(record)
+        ttid = self._by_title.get(normalize_title(title))
+        return self.get(ttid) if ttid is not None else None
+
+    def ttids(self):
+        """TTID всех записей в порядке каталога."""
+        if self.snapshot is not None:
+            yield from self.snapshot.ttids()
+        for record in self.added:
+            yield record[self.key]
+
+    def __iter__(self):
+        for record, _ in self.entries():
+            yield record
+
+    def entries(self):
+        """Пары (запись, байты из снимка); для новых и изменённых записей байтов нет (None)."""
+        if self.snapshot is not None:
+            for index in range(len(self.snapshot)):
+                raw = self.snapshot.raw(index)
+                record = json.loads(raw.decode("utf-8"))
+                replaced = self._replaced.get(record.get(self.key))
+                yield (record, raw) if replaced is None else (replaced, None)
+        for record in self.added:
+            yield record, None
+
+    @property
+    def records(self):
+        """Все записи списком (декодирует весь снимок — только для кода, которому нужен список)."""
+        return list(self)
+
+    @property
+    def next_id(self):
+        """Следующий свободный ID."""
+        return self._max_id + 1
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    def _reopen(self, snapshot):
+        """Переключается на новый снимок, в который уже вошли добавленные записи."""
+        self.close()
+        self.snapshot = snapshot
+        self.added = []
+        self._added_by_ttid = {}
+        self._replaced = {}
+        self._max_id = max(self._max_id, snapshot.max_id)
+
+
+def snapshot_path(json_file):
+    """Путь к снимку рядом с JSON-экспортом: anime_list.json → anime_list.bin."""
+    return Path(json_file).with_suffix(SNAPSHOT_SUFFIX)
+
+
+def load_snapshot_catalog(json_file, snapshot_file=None, key="TTID"):
+    """Открывает каталог через снимок; если снимка нет или JSON новее, снимок пересобирается из JSON."""
+    json_file = Path(json_file)
+    snapshot_file = Path(snapshot_file) if snapshot_file else snapshot_path(json_file)
+    json_mtime = json_file.stat().st_mtime if json_file.exists() else None
+    if snapshot_file.exists() and (json_mtime is None or snapshot_file.stat().st_mtime >= json_mtime):
+        try:
+            return SnapshotCatalog(CatalogSnapshot(snapshot_file, key), key)
+        except ValueError as e:
+            print(f"Снимок каталога повреждён ({e}), пересобираем из {json_file}")
+
+    if json_mtime is None:
+        return SnapshotCatalog(key=key)
+    try:
+        with open(json_file, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    except Exception as e:
+        print(f"Ошибка при чтении JSON файла: {e}")
+        return SnapshotCatalog(key=key)
+    write_snapshot(records, snapshot_file, key)
+    print(f"Снимок каталога {snapshot_file} собран из {json_file} ({len(records)} записей)")
+    return SnapshotCatalog(CatalogSnapshot(snapshot_file, key), key)
+
+
+def write_json_stream(entries, json_file):
+    """Пишет записи из пар (запись, байты) в JSON-файл по одной, в том же виде,
+    что json.dump(records, indent=4, ensure_ascii=False).
+
+    Это генератор: пары отдаются дальше по мере записи, а файл заменяется, когда он исчерпан.
+    """
+    json_file = Path(json_file)
+    tmp_path = json_file.with_suffix(json_file.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("[")
+        first = True
+        for entry in entries:
+            record = entry[0]
+            f.write("\n" if first else ",\n")
+            f.write("    " + EXPORT_ENCODER.encode(record).replace("\n", "\n    "))
+            first = False
+            yield entry
+        f.write("]" if first else "\n]")
+    os.replace(tmp_path, json_file)
+
+
+def save_catalog(catalog, json_file, snapshot_file=None, key="TTID"):
+    """Сохраняет каталог в JSON-экспорт и в снимок рядом с ним, не собирая все записи в один список.
+
+    `catalog` — SnapshotCatalog или любая последовательность записей. SnapshotCatalog
+    после сохранения переключается на новый снимок; старый закрывается до замены файла
+    (на Windows отображённый в память файл заменить нельзя).
+    """
+    snapshot_file = Path(snapshot_file) if snapshot_file else snapshot_path(json_file)
+    tmp_path = snapshot_file.with_suffix(snapshot_file.suffix + ".new")
+    # Один проход: каждая запись декодируется один раз, а неизменённые записи снимка
+    # копируются в новый снимок как есть, без повторного кодирования
+    entries = catalog.entries() if isinstance(catalog, SnapshotCatalog) else ((record, None) for record in catalog)
+    _write_snapshot(write_json_stream(entries, json_file), len(catalog), tmp_path, key)
+    if isinstance(catalog, SnapshotCatalog):
+        catalog.close()
+        os.replace(tmp_path, snapshot_file)
+        catalog._reopen(CatalogSnapshot(snapshot_file, key))
+    else:
+        os.replace(tmp_path, snapshot_file)
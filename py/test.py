@@ -1,18 +1,13 @@
-import json
-import re
 import time
-from selenium import webdriver
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.firefox import GeckoDriverManager
-from bs4 import BeautifulSoup
-from pymongo import MongoClient
 from dotenv import load_dotenv
 import os
-from pathlib import Path
+from browser import click_more, create_driver, wait_for_more_items
+from snapshot import load_snapshot_catalog, save_catalog
+from discovery import (IMDB_DELTA_PAGE_URL, IMDB_SEARCH_PAGE_URL, DeltaFrontier, discover_delta, discover_http,
+                       discover_sharded, extract_new_items)
 
 load_dotenv()
 
@@ -21,21 +16,47 @@ class AnimeConfig:
     def __init__(self, limit=1000, delay=2):
         self.LIMIT = limit
         self.DELAY = delay
+        # "http" — без браузера, "sharded" — по шардам в пуле процессов, "selenium" — через Firefox,
+        # "delta" — только новое: от свежих релизов до границы прошлого обхода (см. DeltaFrontier)
+        self.DISCOVERY_BACKEND = "http"
+        self.DELTA_PAGE_SIZE = 50
+        self.DELTA_LIMIT = 200  # Сколько новых TTID искать за один запуск "delta" (LIMIT на этот режим не влияет)
+        self.LEAN_CRAWL = True  # Selenium: headless, без картинок/медиа/трекеров и без фиксированных пауз
+        self.DISCOVERY_PROCESSES = None  # Процессов для "sharded" (None — по числу ядер)
         self.MONGODB_URI = os.getenv('MONGODB_URI')
         self.DB_NAME = os.getenv('DB_NAME', 'anime_db')
         self.COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'anime_ttid_list')
         self.JSON_FILE = "anime_ttid_list.json"
+        self.SNAPSHOT_FILE = "anime_ttid_list.bin"
+        self.FRONTIER_FILE = "anime_ttid_list_frontier.json"
 
 
-def get_anime_ttid_list(config, language, existing_ttids, needed_count):
+def get_anime_ttid_list(config, language, existing_ttids, needed_count, frontier=None):
+    """Собирает новые TTID с IMDb: по HTTP, а если это не удалось — через Selenium."""
     if needed_count <= 0:
         return []
 
-    url = "https://m.imdb.com/search/title/?title_type=feature,tv_movie,tv_special,video,tv_series,tv_miniseries&interests=in0000027"
-    options = Options()
-    options.set_preference("intl.accept_languages", language)
-    service = Service(GeckoDriverManager().install())
-    driver = webdriver.Firefox(service=service, options=options)
+    if frontier is not None:
+        found = discover_delta(language, existing_ttids, needed_count, frontier, page_size=config.DELTA_PAGE_SIZE)
+    elif config.DISCOVERY_BACKEND == "sharded":
+        found = discover_sharded(language, existing_ttids, needed_count, processes=config.DISCOVERY_PROCESSES)
+    elif config.DISCOVERY_BACKEND == "http":
+        found = discover_http(language, existing_ttids, needed_count)
+    else:
+        found = None
+
+    if found is not None:
+        print(f"Всего собрано {len(found)} TTID")
+        return [{"ttid": item["ttid"]} for item in found]
+    if config.DISCOVERY_BACKEND != "selenium":
+        print("Переключаемся на Selenium...")
+
+    return get_anime_ttid_list_selenium(config, language, existing_ttids, needed_count, frontier)
+
+
+def get_anime_ttid_list_selenium(config, language, existing_ttids, needed_count, frontier=None):
+    url = IMDB_DELTA_PAGE_URL if frontier is not None else IMDB_SEARCH_PAGE_URL
+    driver = create_driver(language, lean=config.LEAN_CRAWL)
     driver.get(url)
     ttid_list = []
     attempts = 0
@@ -45,20 +66,25 @@ def get_anime_ttid_list(config, language, existing_ttids, needed_count):
         EC.presence_of_element_located((By.CLASS_NAME, "ipc-metadata-list-summary-item"))
     )
 
+    processed = 0
+    head = None
+    reached = False
     while len(ttid_list) < needed_count and attempts < max_attempts:
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        anime_items = soup.find_all("li", class_="ipc-metadata-list-summary-item")
-        print(f"Попытка {attempts + 1}: найдено {len(anime_items)} элементов")
-
-        new_items = anime_items[len(ttid_list):]
+        # Забираем со страницы только элементы, появившиеся после прошлой итерации
+        total, new_items = extract_new_items(driver, processed)
+        processed = total
+        print(f"Попытка {attempts + 1}: найдено {total} элементов")
         print(f"Новых элементов: {len(new_items)}")
+        if frontier is not None:
+            ttids = [item["ttid"] for item in new_items if item]
+            head = ttids if head is None else head
+            reached = frontier.reached(ttids, existing_ttids)
 
         for item in new_items:
-            ttid_match = re.search(r"/title/(tt\d+)/", item.find("a")["href"]) if item.find("a") else None
-            if not ttid_match:
+            if not item:
                 print("Пропуск: TTID не найден")
                 continue
-            ttid = ttid_match.group(1)
+            ttid = item["ttid"]
 
             if ttid in existing_ttids:
                 print(f"Пропуск {ttid} - уже существует")
@@ -71,8 +97,20 @@ def get_anime_ttid_list(config, language, existing_ttids, needed_count):
                 break
 
         print(f"Собрано {len(ttid_list)} из {needed_count}")
+        if reached:
+            print("Дошли до границы прошлого обхода")
+            break
 
-        if len(ttid_list) < needed_count:
+        if len(ttid_list) < needed_count and config.LEAN_CRAWL:
+            try:
+                # Без фиксированных пауз: ждём ровно до появления новых элементов
+                click_more(driver)
+                print(f"Подгружено: {wait_for_more_items(driver, processed)} элементов")
+                attempts += 1
+            except Exception as e:
+                print(f"Не удалось загрузить больше данных: {e}")
+                break
+        elif len(ttid_list) < needed_count:
             try:
                 print("Ищем кнопку '50 more'...")
                 next_button = WebDriverWait(driver, 10).until(
@@ -94,8 +132,7 @@ def get_anime_ttid_list(config, language, existing_ttids, needed_count):
 
                 print("Ждем загрузки новых элементов...")
                 WebDriverWait(driver, 15).until(
-                    lambda driver: len(driver.find_elements(By.CLASS_NAME, "ipc-metadata-list-summary-item")) > len(
-                        anime_items)
+                    lambda driver: len(driver.find_elements(By.CLASS_NAME, "ipc-metadata-list-summary-item")) > processed
                 )
                 time.sleep(config.DELAY)
                 attempts += 1
@@ -105,19 +142,18 @@ def get_anime_ttid_list(config, language, existing_ttids, needed_count):
 
     print(f"Всего собрано {len(ttid_list)} TTID")
     driver.quit()
+    if frontier is not None and head is not None:
+        frontier.finish(head, reached, limit_reached=attempts >= max_attempts)
     return ttid_list
 
 
-def load_existing_ttids(json_file):
+def load_existing_ttids(json_file, snapshot_file=None):
+    """Множество существующих TTID (без повторов) через снимок каталога, без разбора всего JSON."""
+    catalog = load_snapshot_catalog(json_file, snapshot_file, key="ttid")
     try:
-        if Path(json_file).exists():
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return {item["ttid"] for item in data}
-        return set()
-    except Exception as e:
-        print(f"Ошибка при чтении JSON: {e}")
-        return set()
+        return set(catalog.ttids())
+    finally:
+        catalog.close()
 
 
 
@@ -126,21 +162,28 @@ def load_existing_ttids(json_file):
 if __name__ == "__main__":
     config = AnimeConfig(limit=1000, delay=2)
 
-    existing_ttids = load_existing_ttids(config.JSON_FILE)
+    existing_ttids = load_existing_ttids(config.JSON_FILE, config.SNAPSHOT_FILE)
     print(f"Найдено {len(existing_ttids)} существующих TTID")
 
-    needed_count = config.LIMIT - len(existing_ttids)
+    if config.DISCOVERY_BACKEND == "delta":
+        needed_count = config.DELTA_LIMIT
+    else:
+        needed_count = config.LIMIT - len(existing_ttids)
     print(f"Требуется найти {needed_count} новых TTID")
 
     if needed_count > 0:
         print("Сбор TTID на английском...")
-        new_ttids = get_anime_ttid_list(config, "en-US, en", existing_ttids, needed_count)
+        frontier = DeltaFrontier(config.FRONTIER_FILE, "en-US, en") if config.DISCOVERY_BACKEND == "delta" else None
+        new_ttids = get_anime_ttid_list(config, "en-US, en", existing_ttids, needed_count, frontier)
 
-        combined_data = [{"ttid": ttid["ttid"]} for ttid in new_ttids] + [{"ttid": ttid} for ttid in existing_ttids]
+        # Новые TTID в начале; повторы из старого файла отбрасываются
+        ttids = dict.fromkeys([ttid["ttid"] for ttid in new_ttids] + list(existing_ttids))
+        combined_data = [{"ttid": ttid} for ttid in ttids]
 
-        with open(config.JSON_FILE, "w", encoding="utf-8") as f:
-            json.dump(combined_data, f, ensure_ascii=False, indent=4)
+        save_catalog(combined_data, config.JSON_FILE, config.SNAPSHOT_FILE, key="ttid")
         print(f"Сохранено {len(combined_data)} TTID в {config.JSON_FILE}")
+        if frontier is not None:
+            frontier.save()
 
 
     else:
@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+
+
+class Vocabulary:
+    """Словарь переводов тегов или жанров (англ. → рус.) с компактными целочисленными кодами.
+
+    Файл читается один раз и перечитывается, только если изменилось время его модификации.
+    Коды уже известных названий при перечитывании не меняются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._codes = {}  # Английское название → код
+        self._labels = []  # Код → русское название
+        self._active = set()  # Коды, присутствующие в текущей версии файла
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            translations = {}
+            if mtime is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        translations = json.load(f)
+                except Exception as e:
+                    print(f"Ошибка при чтении {self.path}: {e}")
+            active = set()
+            for name, label in translations.items():
+                code = self._codes.get(name)
+                if code is None:
+                    code = self._codes[name] = len(self._labels)
+                    self._labels.append(label)
+                else:
+                    self._labels[code] = label
+                active.add(code)
+            self._active = active
+            self._mtime = mtime
+
+    def __len__(self):
+        self._refresh()
+        return len(self._active)
+
+    def encode(self, names):
+        """Оставляет только известные названия и возвращает их коды."""
+        self._refresh()
+        codes = self._codes
+        active = self._active
+        return [codes[name] for name in names if name in codes and codes[name] in active]
+
+    def decode(self, codes):
+        """Переводит коды в русские названия."""
+        self._refresh()
+        return [self._labels[code] for code in codes]
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_vocabulary(path):
+    """Возвращает общий для процесса словарь для файла `path`."""
+    with _registry_lock:
+        if path not in _registry:
+            _registry[path] = Vocabulary(path)
+        return _registry[path]